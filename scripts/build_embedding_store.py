@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+将学生bank中零散的 {uid}_description.npz / {uid}_keywords.npz 合并为每个数据集一个的连续embedding存储
+
+存储格式（{bank_dir}/{persona|memory}/{dataset}/embedding_store/）:
+- {kind}.npy: 所有学生的embedding按行拼接成的 (N, d) float32 矩阵（已L2归一化），运行时用np.memmap读取
+- index.json: {"version": 1, "dim": d, "normalized": true, "kinds": [...], "uids": {uid: [offset, count]}}
+
+persona存 description + keywords，memory只存 description（检索时memory不使用keywords embedding）
+"""
+
+import argparse
+import json
+import os
+import shutil
+import zipfile
+import numpy as np
+from tqdm import tqdm
+
+BANK_DIR = "/mnt/localssd/bank"
+STORE_DIRNAME = "embedding_store"
+STORE_VERSION = 1
+
+# 每种bank需要合并的embedding类型
+STORE_KINDS = {
+    'persona': ['description', 'keywords'],
+    'memory': ['description'],
+}
+
+
+def read_npz_shape(npz_file):
+    """只读取npz中embeddings数组的header，不解压整个数组"""
+    with zipfile.ZipFile(npz_file) as zf:
+        with zf.open('embeddings.npy') as f:
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+    return shape, dtype
+
+
+def collect_uids(emb_dir, kinds):
+    """找出所有kind的npz都存在的学生，返回 {uid: 行数}"""
+    uids = {}
+    suffix = f"_{kinds[0]}.npz"
+    for filename in sorted(os.listdir(emb_dir)):
+        if not filename.endswith(suffix):
+            continue
+        uid = filename[:-len(suffix)]
+        if not all(os.path.exists(f"{emb_dir}/{uid}_{kind}.npz") for kind in kinds):
+            continue
+
+        shapes = [read_npz_shape(f"{emb_dir}/{uid}_{kind}.npz")[0] for kind in kinds]
+        if len(shapes[0]) != 2 or any(shape != shapes[0] for shape in shapes):
+            print(f"  ⚠️  {uid}: embedding形状不一致 {shapes}，跳过")
+            continue
+        uids[uid] = shapes[0]
+    return uids
+
+
+def build_store(bank_dir, bank_type, dataset, delete_npz=False):
+    """为一个数据集的persona或memory构建合并存储"""
+    kinds = STORE_KINDS[bank_type]
+    emb_dir = f"{bank_dir}/{bank_type}/{dataset}/embeddings"
+    store_dir = f"{bank_dir}/{bank_type}/{dataset}/{STORE_DIRNAME}"
+
+    if not os.path.isdir(emb_dir):
+        print(f"⚠️  目录不存在: {emb_dir}")
+        return None
+
+    # 第一遍：只读header，确定每个学生的行数和总大小
+    shapes = collect_uids(emb_dir, kinds)
+    if not shapes:
+        print(f"⚠️  {emb_dir} 中没有可合并的embedding")
+        return None
+
+    dims = {shape[1] for shape in shapes.values()}
+    if len(dims) != 1:
+        raise ValueError(f"{emb_dir} 中embedding维度不一致: {dims}")
+    dim = dims.pop()
+
+    index = {}
+    offset = 0
+    for uid, shape in shapes.items():
+        index[uid] = [offset, shape[0]]
+        offset += shape[0]
+    total_rows = offset
+
+    # 第二遍：写入临时目录，完成后再替换，避免读到写了一半的存储
+    tmp_dir = f"{store_dir}.tmp"
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    for kind in kinds:
+        out = np.lib.format.open_memmap(f"{tmp_dir}/{kind}.npy", mode='w+',
+                                        dtype=np.float32, shape=(total_rows, dim))
+        for uid, (start, count) in tqdm(index.items(), desc=f"{bank_type}/{dataset}/{kind}"):
+            if count == 0:
+                continue
+            embs = np.asarray(np.load(f"{emb_dir}/{uid}_{kind}.npz", allow_pickle=True)['embeddings'],
+                              dtype=np.float32)
+            norms = np.linalg.norm(embs, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            out[start:start + count] = embs / norms
+        out.flush()
+        del out
+
+    with open(f"{tmp_dir}/index.json", 'w') as f:
+        json.dump({
+            'version': STORE_VERSION,
+            'dim': int(dim),
+            'normalized': True,
+            'kinds': kinds,
+            'uids': index,
+        }, f)
+
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.rename(tmp_dir, store_dir)
+
+    print(f"✅ {bank_type}/{dataset}: {len(index)}个学生, {total_rows}行, dim={dim} -> {store_dir}")
+
+    if delete_npz:
+        for uid in index:
+            for kind in kinds:
+                os.remove(f"{emb_dir}/{uid}_{kind}.npz")
+        print(f"   已删除 {len(index) * len(kinds)} 个npz文件")
+
+    return store_dir
+
+
+def build_dataset_store(dataset, bank_dir=BANK_DIR, delete_npz=False):
+    """为一个数据集构建persona和memory的合并存储"""
+    for bank_type in STORE_KINDS:
+        build_store(bank_dir, bank_type, dataset, delete_npz=delete_npz)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Consolidate per-student embedding npz files into a memory-mapped store')
+    parser.add_argument('--dataset', type=str, nargs='+', required=True,
+                       choices=['assist2017', 'nips_task34', 'algebra2005', 'bridge2006'])
+    parser.add_argument('--bank-dir', type=str, default=BANK_DIR)
+    parser.add_argument('--delete-npz', action='store_true',
+                       help='Remove the per-student npz files after a successful migration')
+
+    args = parser.parse_args()
+
+    for dataset in args.dataset:
+        build_dataset_store(dataset, bank_dir=args.bank_dir, delete_npz=args.delete_npz)
+
+
+if __name__ == '__main__':
+    main()
@@ -23,6 +23,8 @@ except ImportError:
 import openai
 import time
 
+from build_embedding_store import build_dataset_store
+
 # LLM配置
 ENDPOINT = ""  # Your API endpoint
 KEY = ""  # Your API key
@@ -36,6 +38,9 @@ openai.api_base = ENDPOINT
 # 并行处理配置
 MAX_WORKERS = 30  # 按学生并行的进程数（每个进程处理完整学生流程：LLM + BGE + 保存）
 
+# 共享模型服务（src/tasa/model_server.py）的Unix socket；设置后worker不再各自加载BGE-M3
+MODEL_SERVER_SOCKET = None  # e.g. "/tmp/tasa_model_server.sock"
+
 # 数据集配置 - 包含train_valid和test
 DATASETS = {
     'assist2017': {
@@ -448,6 +453,9 @@ def generate_embeddings_batch(texts, model):
         # 旧版FlagModel (v1.1.6) 的encode()方法不接受return_dense等参数
         # 直接调用encode会返回dense embeddings
         result = model.encode(texts, batch_size=min(32, len(texts)))
+        # 新版BGEM3FlagModel和模型服务客户端返回 {'dense_vecs': ...}
+        if isinstance(result, dict):
+            result = result['dense_vecs']
         return result
     except Exception as e:
         print(f"  Embedding生成失败: {e}")
@@ -482,6 +490,9 @@ def save_student_files(uid, personas, memories, last_interactions, dataset_name,
             key_emb_file = f"{emb_dir}/{uid}_keywords.npz"
             np.savez_compressed(key_emb_file, embeddings=key_embs)
     
+    # Memory按concept排序（稳定排序，保留concept内的时间顺序），检索时每个concept是连续的一段行
+    memories = sorted(memories, key=lambda m: m['concept_text'])
+    
     # Memory数据文件
     memory_data_file = f"{base_dir}/memory/{dataset_name}/data/{uid}.json"
     os.makedirs(os.path.dirname(memory_data_file), exist_ok=True)
@@ -520,8 +531,14 @@ def get_worker_bge_model():
     """获取当前worker进程的BGE模型（lazy initialization）"""
     global _worker_bge_model
     if _worker_bge_model is None:
-        print(f"  [Worker {os.getpid()}] 初始化BGE模型...")
-        _worker_bge_model = BGEM3FlagModel('BAAI/bge-m3', use_fp16=True)
+        if MODEL_SERVER_SOCKET:
+            # 连接共享模型服务，所有worker的encode请求在服务端合并成micro-batch
+            from tasa_model_server import ModelServerClient
+            print(f"  [Worker {os.getpid()}] 连接模型服务: {MODEL_SERVER_SOCKET}")
+            _worker_bge_model = ModelServerClient(MODEL_SERVER_SOCKET)
+        else:
+            print(f"  [Worker {os.getpid()}] 初始化BGE模型...")
+            _worker_bge_model = BGEM3FlagModel('BAAI/bge-m3', use_fp16=True)
     return _worker_bge_model
 
 def process_student_complete(row, dataset_name, idx2concept):
@@ -647,6 +664,10 @@ def process_dataset(dataset_name, config, max_students=None):
     errors = sum(1 for r in results if r['status'] == 'error')
     
     print(f"\n✅ {dataset_name} 完成: 成功{success}, 跳过{skipped}, 错误{errors}")
+    
+    # 合并零散的npz为memmap存储（检索时零拷贝读取）
+    print(f"\n合并embedding存储...")
+    build_dataset_store(dataset_name)
 
 def main():
     """主函数"""
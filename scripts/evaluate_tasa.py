@@ -6,20 +6,21 @@ TASA Evaluation模块
 import json
 import os
 from typing import List, Dict, Tuple
-from openai import OpenAI
 
 from tasa_config import *
 from student_roleplay_evaluation import grade_answers
+from llm_client_unified import get_openai_client, raise_for_llm_error
 
 class TASAEvaluator:
     def __init__(self):
         """初始化TASA评估器"""
         print("🔧 初始化TASA Evaluator...")
         
-        self.client = OpenAI(
-            api_key=API_KEY,
-            base_url=ENDPOINT
-        )
+        # 进程内共享的OpenAI客户端（keep-alive连接池）
+        self.client = get_openai_client(API_KEY, ENDPOINT)
+        
+        # 批改函数（多会话runner会替换为受grader并发上限约束的版本）
+        self.grade_answers = grade_answers
         
         print("✅ TASA Evaluator初始化完成")
     
@@ -122,6 +123,7 @@ When answering the following questions:
                 answer = content.strip() if content else "I don't know."
                 
             except Exception as e:
+                raise_for_llm_error(e, 'Student')
                 print(f"\n⚠️ 问题{i}回答失败: {e}")
                 answer = "I don't know."
             
@@ -135,7 +137,7 @@ When answering the following questions:
         
         # 批改
         print(f"   📝 批改中...")
-        total_score, feedback, individual_scores = grade_answers(answers, concept_text)
+        total_score, feedback, individual_scores = self.grade_answers(answers, concept_text)
         
         post_test_accuracy = total_score / len(questions)
         
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+离线预计算forgetting重写结果
+
+重写后的描述只取决于学生bank和session（description, concept, mastery, Δt, FS/level），与实时对话无关。
+这里在tutoring开始前为每个 (学生, concept, forgetting method) 的全部persona和目标concept的memory
+生成重写结果，存到 {REWRITE_STORE_DIR}/{dataset}/rewrites.sqlite，运行时MasteryRewriter直接读取
+
+- 请求并发发出（--workers）
+- 支持断点续跑：已存在的key直接跳过，只有成功的重写才会写入
+"""
+
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
+
+from tasa_config import *
+from tasa_bank import read_student_bank, select_concept
+from tasa_cache import RewriteCache
+from tasa_forgetting import FORGETTING_METHODS, build_forgetting_index, get_forgetting_table
+from tasa_rewrite import MasteryRewriter, rewrite_store_path
+
+
+def collect_jobs(dataset, methods, store, num_students=None):
+    """收集所有尚未预计算的 (key, 重写参数)，相同key只保留一个"""
+    build_forgetting_index(dataset)  # 离线脚本：先（增量）更新forgetting索引
+    table = get_forgetting_table(dataset)
+    if table is None:
+        print(f"⚠️  没有找到 {SESSION_DIR}/{dataset} 的session")
+        return {}
+
+    student_ids = sorted(table.rows)
+    if num_students is not None:
+        student_ids = student_ids[:num_students]
+
+    jobs = {}
+    num_done = 0
+    for student_id in tqdm(student_ids, desc="收集待重写描述"):
+        with open(f"{SESSION_DIR}/{dataset}/{student_id}.json") as f:
+            concept_text = json.load(f)['concept_text']
+
+        try:
+            bank = select_concept(read_student_bank(student_id, dataset), concept_text)
+        except FileNotFoundError as e:
+            print(f"  ⚠️  学生 {student_id}: bank不完整 ({e})，跳过")
+            continue
+
+        descriptions = {item['description'] for item in bank['persona_items'] + bank['memory_items']}
+        for method in methods:
+            state = table.lookup(student_id, method)
+            params = {
+                'concept': concept_text,
+                'mastery': state['mastery'],
+                'delta_t_days': state['delta_t_days'],
+                'forgetting_score': state['forgetting_score'],
+                'forgetting_level': state['forgetting_level'],
+            }
+            for description in descriptions:
+                key = RewriteCache.make_key(REWRITE_MODEL, REWRITE_TEMPERATURE, description, **params)
+                if key in jobs:
+                    continue
+                if store.get(key) is not None:
+                    num_done += 1
+                    continue
+                jobs[key] = dict(description=description, **params)
+
+    print(f"   已完成: {num_done}, 待重写: {len(jobs)}")
+    return jobs
+
+
+def precompute_dataset(dataset, methods, workers, num_students=None):
+    path = rewrite_store_path(dataset)
+    store = RewriteCache(path, policy="reuse")
+    rewriter = MasteryRewriter()
+
+    print(f"\n📚 {dataset} -> {path}")
+    jobs = collect_jobs(dataset, methods, store, num_students)
+    if not jobs:
+        return
+
+    def run(key):
+        try:
+            return key, rewriter.request_rewrite(**jobs[key])
+        except Exception as e:
+            return key, e
+
+    num_failed = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run, key) for key in jobs]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="重写"):
+            key, result = future.result()
+            if isinstance(result, str):
+                store.put(key, result)
+            else:
+                num_failed += 1
+
+    print(f"✅ {dataset}: 成功 {len(jobs) - num_failed}, 失败 {num_failed}（重新运行即可补齐）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线预计算forgetting重写结果')
+    parser.add_argument('--dataset', type=str, nargs='+', required=True, help='数据集名称')
+    parser.add_argument('--methods', type=str, nargs='+', default=list(FORGETTING_METHODS),
+                        choices=list(FORGETTING_METHODS), help='需要预计算的forgetting method')
+    parser.add_argument('--workers', type=int, default=32, help='并发请求数')
+    parser.add_argument('--num-students', type=int, default=None, help='只处理前N个学生（默认全部）')
+    args = parser.parse_args()
+
+    if not REWRITE_STORE_DIR:
+        raise ValueError("REWRITE_STORE_DIR未配置")
+
+    for dataset in args.dataset:
+        precompute_dataset(dataset, args.methods, args.workers, args.num_students)
+
+
+if __name__ == "__main__":
+    main()
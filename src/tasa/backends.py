@@ -0,0 +1,173 @@
+"""
+TASA推理后端模块
+统一加载BGE-M3 embedding模型和bge-reranker，自动选择设备
+- GPU: fp16
+- CPU: fp32，可选int8动态量化（nn.Linear），可配置线程数
+- server: 连接共享模型服务（model_server.py），不在本进程加载模型
+"""
+
+import numpy as np
+from typing import List, Tuple
+from FlagEmbedding import BGEM3FlagModel, FlagReranker
+
+from tasa_config import *
+
+
+def select_device(preferred: str = INFERENCE_DEVICE) -> str:
+    """根据配置和硬件选择推理设备: "auto" 时有GPU用cuda，否则用cpu"""
+    if preferred != "auto":
+        return preferred
+
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+def backend_variant(device: str, quantization: str = CPU_QUANTIZATION) -> str:
+    """后端变体标识（用于区分缓存：不同精度的分数有微小差异）"""
+    if device.startswith("cuda"):
+        return "cuda-fp16"
+    return "cpu-int8" if quantization == "int8" else "cpu-fp32"
+
+
+def _prepare_cpu(num_threads: int = CPU_NUM_THREADS):
+    import torch
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+
+def _quantize_int8(wrapper):
+    """对模型中的nn.Linear做int8动态量化（原地替换）"""
+    import torch
+    torch.quantization.quantize_dynamic(wrapper.model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return wrapper
+
+
+# Parity检查用的样例（加载量化模型时与fp32输出对比）
+PARITY_QUERY = "I want to learn about rotations in geometry"
+PARITY_PASSAGES = [
+    "Student shows needs improvement of 'transformations-rotations' with 40% accuracy over 5 attempts.",
+    "The student struggled with a rotation question.",
+    "Student shows excellent mastery of 'equation-solving' with 90% accuracy over 10 attempts.",
+    "The student aced a proportion problem.",
+]
+
+
+def embedding_drift(model, texts: List[str], ref_embs: np.ndarray) -> float:
+    """1 - cos(参考embedding, 模型embedding) 的最大值"""
+    embs = np.asarray(model.encode(texts)['dense_vecs'], dtype=np.float32)
+    cos = np.sum(ref_embs * embs, axis=1) / (np.linalg.norm(ref_embs, axis=1) * np.linalg.norm(embs, axis=1))
+    return float(np.max(1 - cos))
+
+
+def score_drift(model, pairs: List[List[str]], ref_scores: np.ndarray) -> float:
+    """归一化reranker分数与参考分数的最大绝对差"""
+    scores = np.atleast_1d(np.asarray(model.compute_score(pairs, normalize=True), dtype=np.float64))
+    return float(np.max(np.abs(ref_scores - scores)))
+
+
+def _quantize_checked(model, kind: str, model_name: str):
+    """
+    int8量化并与量化前的fp32输出对比（PARITY_CHECK_ON_LOAD）：记录漂移，超出阈值时重新加载fp32模型
+    """
+    if not PARITY_CHECK_ON_LOAD:
+        return _quantize_int8(model)
+
+    texts = [PARITY_QUERY] + PARITY_PASSAGES
+    pairs = [[PARITY_QUERY, p] for p in PARITY_PASSAGES]
+    if kind == "embedder":
+        ref = np.asarray(model.encode(texts)['dense_vecs'], dtype=np.float32)
+        drift = embedding_drift(_quantize_int8(model), texts, ref)
+        threshold = PARITY_MAX_EMB_DRIFT
+    else:
+        ref = np.atleast_1d(np.asarray(model.compute_score(pairs, normalize=True), dtype=np.float64))
+        drift = score_drift(_quantize_int8(model), pairs, ref)
+        threshold = PARITY_MAX_SCORE_DRIFT
+
+    print(f"   int8 {kind} parity: 最大漂移 {drift:.5f} (阈值 {threshold})")
+    if drift <= threshold:
+        return model
+
+    print(f"   ⚠️ int8 {kind} 漂移超出阈值，回退到fp32")
+    if kind == "embedder":
+        model = BGEM3FlagModel(model_name, use_fp16=False, devices="cpu")
+    else:
+        model = FlagReranker(model_name, use_fp16=False, devices="cpu")
+    model.variant = "cpu-fp32"  # 缓存按实际精度区分
+    return model
+
+
+def model_variant(model, device: str) -> str:
+    """已加载模型的后端变体（模型服务客户端返回服务端的变体）"""
+    return getattr(model, 'variant', None) or backend_variant(device)
+
+
+def load_embedder(device: str = None, quantization: str = CPU_QUANTIZATION,
+                  model_name: str = EMBEDDING_MODEL, local: bool = False):
+    """加载BGE-M3 embedding模型（INFERENCE_BACKEND="server"且local=False时返回模型服务客户端）"""
+    if INFERENCE_BACKEND == "server" and not local:
+        from tasa_model_server import ModelServerClient
+        return ModelServerClient()
+
+    device = device or select_device()
+    if device.startswith("cuda"):
+        return BGEM3FlagModel(model_name, use_fp16=True, devices=device)
+
+    _prepare_cpu()
+    model = BGEM3FlagModel(model_name, use_fp16=False, devices="cpu")
+    return _quantize_checked(model, "embedder", model_name) if quantization == "int8" else model
+
+
+def load_reranker(device: str = None, quantization: str = CPU_QUANTIZATION,
+                  model_name: str = RERANKER_MODEL, local: bool = False):
+    """加载bge-reranker模型（INFERENCE_BACKEND="server"且local=False时返回模型服务客户端）"""
+    if INFERENCE_BACKEND == "server" and not local:
+        from tasa_model_server import ModelServerClient
+        return ModelServerClient()
+
+    device = device or select_device()
+    if device.startswith("cuda"):
+        return FlagReranker(model_name, use_fp16=True, devices=device)
+
+    _prepare_cpu()
+    model = FlagReranker(model_name, use_fp16=False, devices="cpu")
+    return _quantize_checked(model, "reranker", model_name) if quantization == "int8" else model
+
+
+def check_parity(texts: List[str], pairs: List[List[str]],
+                 quantization: str = CPU_QUANTIZATION) -> Tuple[float, float]:
+    """
+    对比CPU后端与fp32参考实现的差异（独立加载两套模型，不受PARITY_CHECK_ON_LOAD影响）
+
+    Returns:
+        max_emb_drift: 1 - cos(参考embedding, 后端embedding) 的最大值
+        max_score_drift: 归一化reranker分数的最大绝对差
+    """
+    ref_embedder = BGEM3FlagModel(EMBEDDING_MODEL, use_fp16=False, devices="cpu")
+    ref_embs = np.asarray(ref_embedder.encode(texts)['dense_vecs'], dtype=np.float32)
+    test_embedder = BGEM3FlagModel(EMBEDDING_MODEL, use_fp16=False, devices="cpu")
+    if quantization == "int8":
+        _quantize_int8(test_embedder)
+    max_emb_drift = embedding_drift(test_embedder, texts, ref_embs)
+
+    ref_reranker = FlagReranker(RERANKER_MODEL, use_fp16=False, devices="cpu")
+    ref_scores = np.atleast_1d(np.asarray(ref_reranker.compute_score(pairs, normalize=True), dtype=np.float64))
+    test_reranker = FlagReranker(RERANKER_MODEL, use_fp16=False, devices="cpu")
+    if quantization == "int8":
+        _quantize_int8(test_reranker)
+    max_score_drift = score_drift(test_reranker, pairs, ref_scores)
+
+    return max_emb_drift, max_score_drift
+
+
+# Parity测试：CPU量化后端相对fp32参考的漂移必须在阈值内
+if __name__ == "__main__":
+    _prepare_cpu()
+    emb_drift, score_drift_ = check_parity([PARITY_QUERY] + PARITY_PASSAGES,
+                                           [[PARITY_QUERY, p] for p in PARITY_PASSAGES])
+
+    print(f"Embedding最大漂移 (1 - cos): {emb_drift:.5f} (阈值 {PARITY_MAX_EMB_DRIFT})")
+    print(f"Reranker分数最大漂移: {score_drift_:.5f} (阈值 {PARITY_MAX_SCORE_DRIFT})")
+
+    assert emb_drift <= PARITY_MAX_EMB_DRIFT, "Embedding漂移超出阈值"
+    assert score_drift_ <= PARITY_MAX_SCORE_DRIFT, "Reranker分数漂移超出阈值"
+    print("✅ Parity测试通过")
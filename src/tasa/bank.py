@@ -0,0 +1,380 @@
+"""
+TASA Student Bank模块
+加载学生的persona/memory数据，并以预归一化矩阵的形式提供向量化打分
+"""
+
+import json
+import os
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Tuple
+
+from tasa_config import *
+
+
+def normalize_rows(mat: np.ndarray) -> np.ndarray:
+    """按行L2归一化（零向量保持为零，避免除零产生nan）"""
+    mat = np.asarray(mat, dtype=np.float32)
+    if mat.ndim == 1:
+        mat = mat.reshape(1, -1)
+    if mat.size == 0:
+        return mat
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+def normalize_query(query_emb: np.ndarray) -> np.ndarray:
+    """归一化query向量"""
+    query_emb = np.asarray(query_emb, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(query_emb)
+    return query_emb / norm if norm > 0 else query_emb
+
+
+def similarity_vectors(query_emb: np.ndarray, desc_mat: np.ndarray,
+                       kw_mat: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    一次矩阵-向量乘法计算所有item的余弦相似度
+
+    Args:
+        query_emb: 已归一化的query向量 (d,)
+        desc_mat: 已归一化的description矩阵 (n, d)
+        kw_mat: 已归一化的keywords矩阵 (n, d)，可以与desc_mat是同一个对象
+
+    Returns:
+        sim_desc, sim_kw: 两个 (n,) 的相似度向量
+    """
+    if desc_mat.shape[0] == 0:
+        empty = np.zeros(0, dtype=np.float32)
+        return empty, empty
+
+    sim_desc = desc_mat @ query_emb
+    # memory没有单独的keywords embedding时，desc和kw是同一个矩阵，不重复计算
+    sim_kw = sim_desc if kw_mat is desc_mat else kw_mat @ query_emb
+    return sim_desc, sim_kw
+
+
+def hybrid_scores(query_emb: np.ndarray, desc_mat: np.ndarray, kw_mat: np.ndarray,
+                  lambda_weight: float = LAMBDA_WEIGHT) -> np.ndarray:
+    """total_score = lambda * sim(query, desc) + (1-lambda) * sim(query, kw)"""
+    sim_desc, sim_kw = similarity_vectors(query_emb, desc_mat, kw_mat)
+    return lambda_weight * sim_desc + (1 - lambda_weight) * sim_kw
+
+
+def top_k_indices(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    部分选择取top-K（argpartition），只对选出的K个排序
+
+    Returns:
+        按分数降序排列的下标
+    """
+    n = len(scores)
+    if n == 0 or k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    if k >= n:
+        return np.argsort(-scores, kind='stable')
+
+    idx = np.argpartition(-scores, k - 1)[:k]
+    return idx[np.argsort(-scores[idx], kind='stable')]
+
+
+def top_reranked(rerank_scores: List[float], candidates: List[Dict], k: int = TOP_K_RERANK) -> List[Dict]:
+    """按reranker分数降序重排候选，返回前k个"""
+    reranked = list(zip(rerank_scores, candidates))
+    reranked.sort(key=lambda x: x[0], reverse=True)
+    return [item for _, item in reranked[:k]]
+
+
+EMBEDDING_STORE_DIRNAME = "embedding_store"
+
+
+class EmbeddingStore:
+    """
+    每个数据集一个的合并embedding存储（由scripts/build_embedding_store.py生成）
+
+    - {kind}.npy: 所有学生拼接成的 (N, d) 已归一化矩阵，通过np.memmap只读映射
+    - index.json: uid -> [offset, count]
+    """
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.index_file = f"{store_dir}/index.json"
+        self.mtime_ns = os.stat(self.index_file).st_mtime_ns
+        with open(self.index_file) as f:
+            index = json.load(f)
+        self.uids = index['uids']
+        self.normalized = index.get('normalized', False)
+        self._matrices = {
+            kind: np.load(f"{store_dir}/{kind}.npy", mmap_mode='r')
+            for kind in index['kinds']
+        }
+
+    def has(self, student_id, kinds: List[str]) -> bool:
+        return str(student_id) in self.uids and all(kind in self._matrices for kind in kinds)
+
+    def get(self, student_id, kind: str) -> np.ndarray:
+        """零拷贝切片"""
+        offset, count = self.uids[str(student_id)]
+        return self._matrices[kind][offset:offset + count]
+
+
+_EMBEDDING_STORES = {}
+_EMBEDDING_STORES_LOCK = threading.Lock()
+
+
+def get_embedding_store(base_dir: str, dataset: str):
+    """获取数据集的合并embedding存储，不存在时返回None；index更新后自动重新打开"""
+    store_dir = f"{base_dir}/{dataset}/{EMBEDDING_STORE_DIRNAME}"
+    try:
+        mtime_ns = os.stat(f"{store_dir}/index.json").st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+    with _EMBEDDING_STORES_LOCK:
+        store = _EMBEDDING_STORES.get(store_dir)
+        if store is None or store.mtime_ns != mtime_ns:
+            store = EmbeddingStore(store_dir)
+            _EMBEDDING_STORES[store_dir] = store
+        return store
+
+
+def _load_embeddings(base_dir: str, dataset: str, student_id: int, kinds: List[str]) -> List[np.ndarray]:
+    """优先从合并存储读取（memmap切片），否则回退到单独的npz文件"""
+    store = get_embedding_store(base_dir, dataset)
+    if store is not None and store.has(student_id, kinds):
+        embs = [store.get(student_id, kind) for kind in kinds]
+        return embs if store.normalized else [normalize_rows(emb) for emb in embs]
+
+    return [
+        normalize_rows(np.load(f"{base_dir}/{dataset}/embeddings/{student_id}_{kind}.npz",
+                               allow_pickle=True)['embeddings'])
+        for kind in kinds
+    ]
+
+
+def student_bank_files(student_id: int, dataset: str) -> List[str]:
+    """学生bank对应的源文件（用于mtime失效判断）"""
+    files = [
+        f"{PERSONA_DIR}/{dataset}/data/{student_id}.json",
+        f"{MEMORY_DIR}/{dataset}/data/{student_id}.json",
+    ]
+    for base_dir, kinds in ((PERSONA_DIR, ['description', 'keywords']), (MEMORY_DIR, ['description'])):
+        store = get_embedding_store(base_dir, dataset)
+        if store is not None and store.has(student_id, kinds):
+            files.append(store.index_file)
+        else:
+            files.extend(f"{base_dir}/{dataset}/embeddings/{student_id}_{kind}.npz" for kind in kinds)
+    return files
+
+
+def read_student_bank(student_id: int, dataset: str) -> Dict:
+    """
+    从磁盘读取并解码学生的完整bank（所有persona + 所有memory）
+
+    item中的description_emb/keywords_emb是归一化矩阵的行视图（余弦相似度与缩放无关）
+    """
+    # 加载persona
+    with open(f"{PERSONA_DIR}/{dataset}/data/{student_id}.json") as f:
+        persona_data = json.load(f)
+
+    # 加载persona embeddings
+    persona_desc, persona_kw = _load_embeddings(PERSONA_DIR, dataset, student_id, ['description', 'keywords'])
+
+    # 组装persona items
+    persona_items = []
+    for i, concept_data in enumerate(persona_data):
+        persona_items.append({
+            'concept_text': concept_data['concept_text'],
+            'description': concept_data['description'],
+            'keywords': concept_data['keywords'],
+            'description_emb': persona_desc[i],
+            'keywords_emb': persona_kw[i],
+            'stats': concept_data['stats']
+        })
+
+    # 加载memory
+    with open(f"{MEMORY_DIR}/{dataset}/data/{student_id}.json") as f:
+        memory_data = json.load(f)
+
+    # 加载memory embeddings（memory可能没有单独的keywords embedding，我们只用description）
+    memory_desc, = _load_embeddings(MEMORY_DIR, dataset, student_id, ['description'])
+
+    memory_items = []
+    for i, mem in enumerate(memory_data):
+        memory_items.append({
+            'concept_text': mem['concept_text'],
+            'description': mem['description'],
+            'keywords': mem.get('keywords', mem['description']),  # 如果没有keywords用description
+            'description_emb': memory_desc[i],
+            'keywords_emb': memory_desc[i],
+            'timestamp': mem.get('timestamp', 0),
+            'response': mem.get('response', 0)
+        })
+
+    return {
+        'persona_items': persona_items,
+        'persona_desc': persona_desc[:len(persona_items)],
+        'persona_kw': persona_kw[:len(persona_items)],
+        'memory_items': memory_items,
+        'memory_desc': memory_desc[:len(memory_items)],
+        'concept_index': concept_row_index(memory_items),
+        'concept_views': {},  # concept_text -> 过滤后的memory视图（按需生成）
+    }
+
+
+def concept_row_index(memory_items: List[Dict]) -> Dict:
+    """
+    构建 concept_text -> memory行 的索引
+
+    bank按concept排序存储时每个concept是一段连续的行，用slice表示（memmap上是零拷贝视图）；
+    旧的未排序bank回退为行号数组
+    """
+    rows = {}
+    for i, mem in enumerate(memory_items):
+        rows.setdefault(mem['concept_text'], []).append(i)
+
+    index = {}
+    for concept_text, concept_rows in rows.items():
+        if concept_rows[-1] - concept_rows[0] + 1 == len(concept_rows):
+            index[concept_text] = slice(concept_rows[0], concept_rows[-1] + 1)
+        else:
+            index[concept_text] = np.asarray(concept_rows, dtype=np.int64)
+    return index
+
+
+def select_concept(full_bank: Dict, concept_text: str) -> Dict:
+    """
+    从完整bank中取出目标concept的视图：persona全部保留，memory只读取目标concept的行
+
+    Returns:
+        bank: {
+            'persona_items': List[Dict], 'persona_desc': (n, d), 'persona_kw': (n, d),
+            'memory_items': List[Dict], 'memory_desc': (m, d), 'memory_kw': (m, d)
+        }
+    """
+    view = full_bank['concept_views'].get(concept_text)
+    if view is not None:
+        return view
+
+    rows = full_bank['concept_index'].get(concept_text, slice(0, 0))
+    if isinstance(rows, slice):
+        memory_items = full_bank['memory_items'][rows]
+    else:
+        memory_items = [full_bank['memory_items'][i] for i in rows]
+    memory_desc = full_bank['memory_desc'][rows]
+
+    view = {
+        'persona_items': full_bank['persona_items'],
+        'persona_desc': full_bank['persona_desc'],
+        'persona_kw': full_bank['persona_kw'],
+        'memory_items': memory_items,
+        'memory_desc': memory_desc,
+        'memory_kw': memory_desc,  # 与description共用同一个矩阵
+    }
+    full_bank['concept_views'][concept_text] = view
+    return view
+
+
+def estimate_bank_bytes(full_bank: Dict) -> int:
+    """粗略估计一个已解码bank占用的内存（矩阵 + 文本；memmap切片不占常驻内存，不计入）"""
+    nbytes = sum(full_bank[name].nbytes for name in ('persona_desc', 'persona_kw', 'memory_desc')
+                 if not isinstance(full_bank[name], np.memmap))
+    for item in full_bank['persona_items'] + full_bank['memory_items']:
+        nbytes += len(item['description']) + len(str(item['keywords'])) + 256  # 256: dict本身的开销
+    return nbytes
+
+
+class StudentBankCache:
+    """
+    已解码学生bank的LRU缓存
+
+    - key: (dataset, student_id)
+    - 按估计字节数和条目数双重限制容量
+    - 源文件mtime变化时自动失效
+    """
+
+    def __init__(self, max_bytes: int = BANK_CACHE_MAX_MB * 1024 * 1024,
+                 max_entries: int = BANK_CACHE_MAX_ENTRIES):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (mtimes, full_bank, nbytes)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _mtimes(student_id: int, dataset: str) -> Tuple:
+        return tuple((path, os.stat(path).st_mtime_ns) for path in student_bank_files(student_id, dataset))
+
+    def get(self, student_id: int, dataset: str) -> Dict:
+        """获取学生的完整bank，未命中或已过期时从磁盘读取"""
+        key = (dataset, str(student_id))
+        mtimes = self._mtimes(student_id, dataset)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] == mtimes:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                # 文件已更新，丢弃旧条目
+                self._remove(key)
+                self.invalidations += 1
+            self.misses += 1
+
+        full_bank = read_student_bank(student_id, dataset)
+        nbytes = estimate_bank_bytes(full_bank)
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (mtimes, full_bank, nbytes)
+            self.total_bytes += nbytes
+            # 超出容量时淘汰最久未使用的条目（至少保留刚放入的这一条）
+            while len(self._entries) > 1 and (self.total_bytes > self.max_bytes or
+                                              len(self._entries) > self.max_entries):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+        return full_bank
+
+    def _remove(self, key):
+        _, _, nbytes = self._entries.pop(key)
+        self.total_bytes -= nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> Dict:
+        """命中率等统计信息"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+            }
+
+
+# 进程内共享的bank缓存（TASARAG和TASARAGLambda共用）
+BANK_CACHE = StudentBankCache()
+
+
+def load_student_bank(student_id: int, dataset: str, concept_text: str,
+                      cache: StudentBankCache = None) -> Dict:
+    """
+    加载学生的persona和memory数据（经过LRU缓存），返回目标concept的预归一化矩阵视图
+    """
+    cache = cache if cache is not None else BANK_CACHE
+    return select_concept(cache.get(student_id, dataset), concept_text)
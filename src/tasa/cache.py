@@ -0,0 +1,297 @@
+"""
+TASA缓存模块
+内存LRU + 可选的SQLite持久化，用于缓存query embedding、reranker分数等可复用的计算结果
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import List, Dict, Optional
+
+from tasa_config import *
+
+
+def content_hash(*parts: str) -> str:
+    """对若干字符串做内容哈希（用\\x00分隔，避免拼接歧义）"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode('utf-8'))
+        h.update(b'\x00')
+    return h.hexdigest()
+
+
+class LRUCache:
+    """线程安全的LRU缓存，带命中统计"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'entries': len(self._data),
+            }
+
+
+class SQLiteKV:
+    """简单的SQLite键值存储（key: TEXT, value: BLOB），多线程共享一个连接"""
+
+    def __init__(self, path: str, table: str = 'kv'):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB)')
+            self._conn.commit()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._conn.execute(f'SELECT value FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, value: bytes):
+        with self._lock:
+            self._conn.execute(f'INSERT OR REPLACE INTO {self.table} (key, value) VALUES (?, ?)', (key, value))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class QueryEmbeddingCache:
+    """
+    Query embedding缓存：按 (模型名, query文本) 的内容哈希缓存dense向量
+
+    - 内存LRU
+    - 可选SQLite持久化（persist_path），进程重启后热门模板（如 "I want to learn about {concept}"）不再经过模型
+    """
+
+    def __init__(self, embed_model, model_name: str = EMBEDDING_MODEL,
+                 max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 persist_path: Optional[str] = QUERY_CACHE_PATH):
+        self.embed_model = embed_model
+        self.model_name = model_name
+        self.memory = LRUCache(max_entries)
+        self.disk = SQLiteKV(persist_path, table='query_embeddings') if persist_path else None
+        self.model_calls = 0
+
+    def _key(self, query: str) -> str:
+        return content_hash(self.model_name, query)
+
+    def _lookup(self, key: str) -> Optional[np.ndarray]:
+        emb = self.memory.get(key)
+        if emb is None and self.disk is not None:
+            blob = self.disk.get(key)
+            if blob is not None:
+                emb = np.frombuffer(blob, dtype=np.float32)
+                self.memory.put(key, emb)
+        return emb
+
+    def encode(self, query: str) -> np.ndarray:
+        """返回单个query的dense向量"""
+        return self.encode_many([query])[0]
+
+    def encode_many(self, queries: List[str]) -> List[np.ndarray]:
+        """批量获取dense向量，只把未命中的query（去重后）送进模型"""
+        keys = [self._key(q) for q in queries]
+        results = [self._lookup(key) for key in keys]
+
+        missing = OrderedDict()
+        for query, key, emb in zip(queries, keys, results):
+            if emb is None:
+                missing.setdefault(key, query)
+
+        if missing:
+            self.model_calls += 1
+            dense = self.embed_model.encode(list(missing.values()))['dense_vecs']
+            dense = np.asarray(dense, dtype=np.float32).reshape(len(missing), -1)
+            computed = {}
+            for key, emb in zip(missing.keys(), dense):
+                emb = np.ascontiguousarray(emb)
+                computed[key] = emb
+                self.memory.put(key, emb)
+                if self.disk is not None:
+                    self.disk.put(key, emb.tobytes())
+            results = [computed[key] if emb is None else emb for key, emb in zip(keys, results)]
+
+        return results
+
+    def stats(self) -> Dict:
+        stats = self.memory.stats()
+        stats['model_calls'] = self.model_calls
+        return stats
+
+
+class RerankScoreCache:
+    """
+    Reranker分数缓存：按 (模型名, query, passage) 的内容哈希缓存归一化后的分数
+
+    只有未命中的pair会送进reranker，结果按原顺序拼回
+    """
+
+    def __init__(self, reranker, model_name: str = RERANKER_MODEL,
+                 max_entries: int = RERANK_CACHE_MAX_ENTRIES,
+                 persist_path: Optional[str] = RERANK_CACHE_PATH):
+        self.reranker = reranker
+        self.model_name = model_name
+        self.memory = LRUCache(max_entries)
+        self.disk = SQLiteKV(persist_path, table='rerank_scores') if persist_path else None
+        self.model_calls = 0
+        self.pairs_scored = 0
+
+    def _key(self, query: str, passage: str) -> str:
+        return content_hash(self.model_name, 'normalized', query, passage)
+
+    def _lookup(self, key: str) -> Optional[float]:
+        score = self.memory.get(key)
+        if score is None and self.disk is not None:
+            blob = self.disk.get(key)
+            if blob is not None:
+                score = float(np.frombuffer(blob, dtype=np.float64)[0])
+                self.memory.put(key, score)
+        return score
+
+    def compute_score(self, pairs: List[List[str]]) -> List[float]:
+        """返回每个 [query, passage] 的归一化reranker分数（与输入顺序一致）"""
+        if len(pairs) == 0:
+            return []
+
+        keys = [self._key(query, passage) for query, passage in pairs]
+        scores = [self._lookup(key) for key in keys]
+
+        # 未命中的pair（去重后）一次性送进reranker
+        missing = OrderedDict()
+        for pair, key, score in zip(pairs, keys, scores):
+            if score is None:
+                missing.setdefault(key, pair)
+
+        if missing:
+            self.model_calls += 1
+            self.pairs_scored += len(missing)
+            computed = self.reranker.compute_score([list(pair) for pair in missing.values()], normalize=True)
+            computed = dict(zip(missing.keys(), np.atleast_1d(np.asarray(computed, dtype=np.float64)).tolist()))
+            for key, score in computed.items():
+                self.memory.put(key, score)
+                if self.disk is not None:
+                    self.disk.put(key, np.float64(score).tobytes())
+            scores = [computed[key] if score is None else score for key, score in zip(keys, scores)]
+
+        return scores
+
+    def stats(self) -> Dict:
+        stats = self.memory.stats()
+        stats['model_calls'] = self.model_calls
+        stats['pairs_scored'] = self.pairs_scored
+        return stats
+
+
+class RewriteCache:
+    """
+    Forgetting重写结果的持久化缓存（SQLite）
+
+    key由重写的全部输入（description, concept, mastery, delta_t_days, forgetting_score, forgetting_level）
+    加上模型名和temperature组成。策略:
+    - "reuse": 每个key只保留一个样本，之后一直复用
+    - "rotate": 每个key最多保留num_samples个样本，凑满之前继续调用LLM补样本，凑满后轮流返回
+    """
+
+    def __init__(self, path: str = REWRITE_CACHE_PATH, policy: str = REWRITE_CACHE_POLICY,
+                 num_samples: int = REWRITE_CACHE_SAMPLES):
+        if policy not in ("reuse", "rotate"):
+            raise ValueError(f"Unknown rewrite cache policy: {policy}")
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.policy = policy
+        self.num_samples = 1 if policy == "reuse" else max(1, num_samples)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS rewrites '
+                               '(key TEXT, idx INTEGER, text TEXT, PRIMARY KEY (key, idx))')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS rewrite_cursor (key TEXT PRIMARY KEY, next INTEGER)')
+            self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, temperature: float, description: str, concept: str, mastery: float,
+                 delta_t_days: float, forgetting_score: float, forgetting_level: str) -> str:
+        """数值按prompt中的精度格式化，保证prompt相同则key相同"""
+        return content_hash(model, f"{temperature}", description, concept, f"{mastery:.2f}",
+                            f"{delta_t_days:.1f}", f"{forgetting_score:.4f}", forgetting_level)
+
+    def get(self, key: str) -> Optional[str]:
+        """命中返回一个样本；需要（继续）调用LLM时返回None"""
+        with self._lock:
+            rows = self._conn.execute('SELECT text FROM rewrites WHERE key = ? ORDER BY idx', (key,)).fetchall()
+            if len(rows) < self.num_samples:
+                self.misses += 1
+                return None
+
+            # 样本已凑满：reuse直接返回，rotate按游标轮流返回
+            self.hits += 1
+            if self.num_samples == 1:
+                return rows[0][0]
+            cursor = self._conn.execute('SELECT next FROM rewrite_cursor WHERE key = ?', (key,)).fetchone()
+            cursor = cursor[0] if cursor else 0
+            self._conn.execute('INSERT OR REPLACE INTO rewrite_cursor (key, next) VALUES (?, ?)',
+                               (key, (cursor + 1) % self.num_samples))
+            self._conn.commit()
+            return rows[cursor % self.num_samples][0]
+
+    def put(self, key: str, text: str):
+        """追加一个样本（已凑满时忽略）"""
+        with self._lock:
+            count = self._conn.execute('SELECT COUNT(*) FROM rewrites WHERE key = ?', (key,)).fetchone()[0]
+            if count < self.num_samples:
+                self._conn.execute('INSERT OR IGNORE INTO rewrites (key, idx, text) VALUES (?, ?, ?)',
+                                   (key, count, text))
+                self._conn.commit()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            keys = self._conn.execute('SELECT COUNT(DISTINCT key) FROM rewrites').fetchone()[0]
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total > 0 else 0.0,
+                'keys': keys,
+                'policy': self.policy,
+            }
@@ -19,6 +19,13 @@ TUTOR_TEMPERATURE = 0.7           # Tutor生成温度
 REWRITE_TEMPERATURE = 0.5         # Rewrite温度
 STUDENT_TEMPERATURE = 1.0         # Student温度（高一些，模拟真实学生）
 GRADER_TEMPERATURE = 0.3          # Grader温度（低一些，保持一致性）
+REWRITE_MODE = "per_item"         # "per_item"（每条描述一次调用，并发）/ "batched"（一轮所有描述一次调用，JSON输出）
+REWRITE_MAX_WORKERS = 6           # 每轮并发重写的最大线程数（单session；runner/service中按REWRITE_MAX_CONCURRENCY）
+REWRITE_CACHE_PATH = None         # 重写结果持久化缓存（None表示不缓存；如 "/mnt/localssd/bank/cache/rewrite_cache.sqlite"）
+REWRITE_CACHE_POLICY = "reuse"    # "reuse"（每个key复用一个样本）/ "rotate"（保留N个样本轮流使用）
+REWRITE_CACHE_SAMPLES = 3         # rotate策略下每个key保留的样本数
+TUTOR_SINGLE_FLIGHT = False       # 合并同时在途的相同tutor请求（如多个session同时开始同一concept；合并后这些session拿到同一份采样）
+REWRITE_SINGLE_FLIGHT = False     # 合并同时在途的相同重写请求（学生role-play需要独立采样，不合并）
 
 # RAG配置
 LAMBDA_WEIGHT = 0.5               # description和keywords的权重平衡
@@ -26,17 +33,58 @@ TOP_K_RETRIEVE = 10               # 初始检索top-K
 TOP_K_RERANK = 3                  # 重排后保留top-K
 EMBEDDING_MODEL = "BAAI/bge-m3"   # Embedding模型
 RERANKER_MODEL = "BAAI/bge-reranker-v2-m3"  # Reranker模型
+BANK_CACHE_MAX_MB = 1024          # 学生bank LRU缓存上限（MB）
+BANK_CACHE_MAX_ENTRIES = 512      # 学生bank LRU缓存最多缓存的学生数
+QUERY_CACHE_MAX_ENTRIES = 4096    # Query embedding内存LRU条目数
+QUERY_CACHE_PATH = None           # Query embedding持久化SQLite路径（None表示只用内存缓存）
+RERANK_CACHE_MAX_ENTRIES = 65536  # Reranker分数内存LRU条目数
+RERANK_CACHE_PATH = None          # Reranker分数持久化SQLite路径（None表示只用内存缓存）
+
+# 推理后端配置（Embedding/Reranker）
+INFERENCE_BACKEND = "local"       # "local"（本进程加载模型）/ "server"（连接共享模型服务）
+INFERENCE_DEVICE = "auto"         # "auto"（有GPU用cuda，否则cpu）/ "cuda" / "cpu"
+CPU_QUANTIZATION = "int8"         # CPU模式: "int8"（动态量化）/ "none"（fp32）
+CPU_NUM_THREADS = 8               # CPU推理线程数
+PARITY_MAX_EMB_DRIFT = 0.02       # Parity测试: embedding 1-cos 的最大允许漂移
+PARITY_MAX_SCORE_DRIFT = 0.05     # Parity测试: 归一化reranker分数的最大允许漂移
+PARITY_CHECK_ON_LOAD = True       # 加载int8量化模型时与fp32输出对比并打印漂移，超出阈值回退到fp32
+MODEL_SERVER_SOCKET = "/tmp/tasa_model_server.sock"  # 模型服务Unix socket路径
+MODEL_SERVER_MAX_BATCH = 64       # 模型服务micro-batch最大条数
+MODEL_SERVER_MAX_WAIT_MS = 5      # 模型服务凑batch的最长等待时间（毫秒）
+MODEL_SERVER_TIMEOUT = 120        # 客户端等待模型服务响应的超时（秒）
 
 # 对话配置
 NUM_TUTORING_ROUNDS = 10          # 教学轮数（生成10次回复）
 MAX_TOKENS_TUTOR = 1000           # Tutor回复最大token数
 MAX_TOKENS_STUDENT = 500          # Student回答最大token数
+CHECKPOINT_ROUNDS = True          # 批量运行时每轮结束后追加per-round checkpoint，崩溃后从最后完成的一轮继续
+
+# 多会话并发配置（tasa_runner）
+SESSION_MAX_CONCURRENCY = 32      # 同时进行的tutoring session数
+TUTOR_MAX_CONCURRENCY = 16        # Tutor endpoint最大并发请求数
+STUDENT_MAX_CONCURRENCY = 32      # Student endpoint最大并发请求数
+REWRITE_MAX_CONCURRENCY = 32      # Rewrite endpoint最大并发请求数
+GRADER_MAX_CONCURRENCY = 8        # Grader endpoint最大并发请求数
+RAG_CROSS_SESSION_BATCHING = True # 多会话时合并各session同一轮的检索（一次encode + 一个reranker batch）
+RAG_BATCH_MAX_SESSIONS = 64       # 一批最多合并的检索请求数
+RAG_BATCH_MAX_WAIT_MS = 20        # 凑批的最长等待时间（毫秒）
+
+# 交互式tutoring服务配置（tasa_service）
+SERVICE_HOST = "0.0.0.0"
+SERVICE_PORT = 8080
+SERVICE_SESSION_STORE = "memory"  # "memory"（进程内）/ "sqlite"（持久化）
+SERVICE_SESSION_DB = "/mnt/localssd/bank/cache/service_sessions.sqlite"  # sqlite session存储路径
+SERVICE_SESSION_IDLE_TTL_S = 1800 # session空闲超过该时间（秒）后被清除
+SERVICE_EVICT_INTERVAL_S = 60     # 空闲session清理间隔（秒）
+SERVICE_MAX_WORKERS = 32          # 执行RAG/LLM调用的线程数
+SERVICE_METRICS_WINDOW = 1000     # 每个endpoint保留最近多少次请求的延迟用于统计
 
 # 文件路径配置
 DIALOGUE_DIR = "/mnt/localssd/bank/dialogue/TASA"
 PERSONA_DIR = "/mnt/localssd/bank/persona"
 MEMORY_DIR = "/mnt/localssd/bank/memory"
 SESSION_DIR = "/mnt/localssd/bank/session"
+REWRITE_STORE_DIR = "/mnt/localssd/bank/rewrite"  # 离线预计算的forgetting重写结果（scripts/precompute_rewrites.py生成，None表示不使用）
 EVALUATION_DIR = "/mnt/localssd/bank/evaluation_results"
 
 # Forgetting curve配置
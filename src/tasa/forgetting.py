@@ -0,0 +1,259 @@
+"""
+TASA Forgetting状态索引
+把 SESSION_DIR/{dataset}/*.json 中每个学生的mastery、delta_t以及六种方法的forgetting score/level
+预先解析成一个紧凑的二进制表（forgetting_index.npy），每个数据集只加载一次，按 (student, method) O(1) 查找
+
+索引中记录了每个session文件的mtime和大小：查找时只stat该学生的文件，文件被原地修改过则重新解析这一行；
+重建索引时未变化的文件直接复用旧的行
+
+构建:
+    python forgetting.py --dataset assist2017
+"""
+
+import argparse
+import json
+import os
+import threading
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+from tasa_config import *
+
+FORGETTING_METHODS = ("history", "lpkt", "dkt", "akt", "simplekt", "simple_time")
+FORGETTING_LEVEL_NAMES = ("low", "moderate", "high")
+FORGETTING_INDEX_FILENAME = "forgetting_index.npy"
+
+_INDEX_DTYPE = np.dtype([
+    ('student_id', np.int64),
+    ('mastery', np.float64),
+    ('delta_t_minutes', np.float64),
+    ('fs', np.float64, (len(FORGETTING_METHODS),)),
+    ('level', np.int8, (len(FORGETTING_METHODS),)),
+    ('fallback', np.bool_, (len(FORGETTING_METHODS),)),   # method缺失，已回退到simple_time
+    ('file_mtime_ns', np.int64),                          # 解析时session文件的mtime和大小，用于判断是否过期
+    ('file_size', np.int64),
+])
+
+
+def simple_time_state(delta_t_days: float) -> Tuple[float, str]:
+    """简单时间衰减公式：F(t) = 1 - 1/(1 + t/7)  (7天半遗忘)"""
+    forgetting_score = 1 - 1 / (1 + delta_t_days / 7)
+    return forgetting_score, get_forgetting_level(forgetting_score)
+
+
+def method_state(session: Dict, method: str, delta_t_days: float) -> Tuple[float, str, bool]:
+    """
+    从session中提取某个method的forgetting score和level
+
+    Returns:
+        forgetting_score, forgetting_level, fallback（method不存在时回退到simple_time）
+    """
+    if method == "simple_time":
+        return (*simple_time_state(delta_t_days), False)
+    if method not in FORGETTING_METHODS:
+        raise ValueError(f"Unknown FORGETTING_SCORE_METHOD: {method}")
+
+    if 'methods' not in session or method not in session['methods']:
+        return (*simple_time_state(delta_t_days), True)
+
+    method_data = session['methods'][method]
+    forgetting_score = method_data.get('fs', 0.0)
+    # 直接使用method中的level（映射：medium -> moderate, high -> high, low -> low）
+    method_level = method_data.get('level', '')
+    if method_level == 'medium':
+        forgetting_level = 'moderate'
+    elif method_level in ('high', 'low'):
+        forgetting_level = method_level
+    # 如果level不存在，根据methods的判断逻辑：high(>0.3), medium(0.15-0.3), low(<0.15)
+    elif forgetting_score > 0.3:
+        forgetting_level = 'high'
+    elif forgetting_score > 0.15:
+        forgetting_level = 'moderate'
+    else:
+        forgetting_level = 'low'
+    return forgetting_score, forgetting_level, False
+
+
+def session_row(student_id: int, session: Dict) -> np.ndarray:
+    """把一个session解析成索引中的一行"""
+    row = np.zeros((), dtype=_INDEX_DTYPE)
+    delta_t_minutes = session.get('delta_t_minutes', 0)
+    delta_t_days = delta_t_minutes / (24 * 60)
+
+    row['student_id'] = student_id
+    row['mastery'] = session['persona']['stats']['correct'] / session['persona']['stats']['total']
+    row['delta_t_minutes'] = delta_t_minutes
+    for i, method in enumerate(FORGETTING_METHODS):
+        forgetting_score, forgetting_level, fallback = method_state(session, method, delta_t_days)
+        row['fs'][i] = forgetting_score
+        row['level'][i] = FORGETTING_LEVEL_NAMES.index(forgetting_level)
+        row['fallback'][i] = fallback
+    return row
+
+
+def read_session_row(session_file: str, student_id: int) -> np.ndarray:
+    """读取并解析一个session文件，记录解析时文件的mtime和大小"""
+    stat = os.stat(session_file)
+    with open(session_file) as f:
+        row = session_row(student_id, json.load(f))
+    row['file_mtime_ns'] = stat.st_mtime_ns
+    row['file_size'] = stat.st_size
+    return row
+
+
+def _load_index(index_file: str) -> Optional[np.ndarray]:
+    """读取已有索引；不存在或格式不兼容（旧版本）时返回None"""
+    try:
+        table = np.load(index_file)
+    except (FileNotFoundError, ValueError, OSError):
+        return None
+    return table if table.dtype == _INDEX_DTYPE else None
+
+
+def build_forgetting_index(dataset: str, session_dir: str = SESSION_DIR) -> Optional[str]:
+    """
+    扫描一个数据集的session目录，写出forgetting_index.npy（按student_id排序）
+
+    mtime和大小都没有变化的文件复用旧索引中的行，只解析新增或修改过的文件
+    """
+    dataset_dir = f"{session_dir}/{dataset}"
+    if not os.path.isdir(dataset_dir):
+        print(f"⚠️  目录不存在: {dataset_dir}")
+        return None
+
+    index_file = f"{dataset_dir}/{FORGETTING_INDEX_FILENAME}"
+    old_table = _load_index(index_file)
+    old_rows = {} if old_table is None else {int(row['student_id']): row for row in old_table}
+
+    rows = []
+    num_parsed = 0
+    for entry in os.scandir(dataset_dir):
+        stem, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not stem.isdigit():
+            continue
+        stat = entry.stat()
+        old_row = old_rows.get(int(stem))
+        if (old_row is not None and old_row['file_mtime_ns'] == stat.st_mtime_ns
+                and old_row['file_size'] == stat.st_size):
+            rows.append(old_row)
+            continue
+        try:
+            rows.append(read_session_row(entry.path, int(stem)))
+            num_parsed += 1
+        except (json.JSONDecodeError, KeyError, ZeroDivisionError) as e:
+            print(f"  ⚠️  {entry.name}: 解析失败 ({e})，跳过")
+
+    table = np.array(rows, dtype=_INDEX_DTYPE)
+    table = table[np.argsort(table['student_id'], kind='stable')]
+
+    # 先写临时文件再替换，避免读取方看到写了一半的索引
+    tmp_file = f"{index_file}.tmp.npy"
+    np.save(tmp_file, table)
+    os.replace(tmp_file, index_file)
+    print(f"✅ {dataset}: {len(table)} 个学生的forgetting状态（重新解析 {num_parsed} 个）-> {index_file}")
+    return index_file
+
+
+def row_state(row: np.ndarray, method: str = FORGETTING_SCORE_METHOD) -> Dict:
+    """
+    从索引的一行中取出某个method的状态
+
+    Returns:
+        mastery, delta_t_days, delta_t_minutes, forgetting_score, forgetting_level, fallback
+    """
+    if method not in FORGETTING_METHODS:
+        raise ValueError(f"Unknown FORGETTING_SCORE_METHOD: {method}")
+
+    m = FORGETTING_METHODS.index(method)
+    delta_t_minutes = float(row['delta_t_minutes'])
+    return {
+        'mastery': float(row['mastery']),
+        'delta_t_days': delta_t_minutes / (24 * 60),
+        'delta_t_minutes': delta_t_minutes,
+        'forgetting_score': float(row['fs'][m]),
+        'forgetting_level': FORGETTING_LEVEL_NAMES[row['level'][m]],
+        'fallback': bool(row['fallback'][m]),
+    }
+
+
+class ForgettingTable:
+    """
+    一个数据集的forgetting状态表
+
+    lookup时stat该学生的session文件，mtime或大小与索引不一致（文件被原地修改）时重新解析并更新内存中的行
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.session_dir = os.path.dirname(index_file)
+        self.mtime_ns = os.stat(index_file).st_mtime_ns
+        self.table = _load_index(index_file)
+        if self.table is None:
+            raise ValueError(f"Incompatible forgetting index: {index_file}")
+        self.rows = {int(student_id): i for i, student_id in enumerate(self.table['student_id'])}
+        self._lock = threading.Lock()
+
+    def __contains__(self, student_id) -> bool:
+        return int(student_id) in self.rows
+
+    def lookup(self, student_id: int, method: str = FORGETTING_SCORE_METHOD) -> Dict:
+        i = self.rows[int(student_id)]
+        session_file = f"{self.session_dir}/{int(student_id)}.json"
+        stat = os.stat(session_file)  # 文件已删除时抛出FileNotFoundError（与直接读取session文件一致）
+
+        with self._lock:
+            row = self.table[i]
+            if row['file_mtime_ns'] != stat.st_mtime_ns or row['file_size'] != stat.st_size:
+                self.table[i] = read_session_row(session_file, int(student_id))
+                row = self.table[i]
+            return row_state(row, method)
+
+
+_FORGETTING_TABLES = {}
+_FORGETTING_TABLES_LOCK = threading.Lock()
+
+
+def get_forgetting_table(dataset: str, session_dir: str = SESSION_DIR) -> Optional[ForgettingTable]:
+    """
+    获取数据集的forgetting状态表（进程内只加载一次；索引文件被重新构建后自动重新打开）
+
+    这里只读取索引，不会构建：索引由CLI（python forgetting.py --dataset ...）或runner启动时离线构建。
+    索引不存在或格式过旧时返回None，调用方逐个读取session文件；
+    索引之后新增的学生同样由调用方回退到读取文件，原地修改的session文件由ForgettingTable.lookup逐行检测
+    """
+    index_file = f"{session_dir}/{dataset}/{FORGETTING_INDEX_FILENAME}"
+
+    with _FORGETTING_TABLES_LOCK:
+        try:
+            index_mtime_ns = os.stat(index_file).st_mtime_ns
+        except FileNotFoundError:
+            index_mtime_ns = None
+
+        if index_mtime_ns is None:
+            _FORGETTING_TABLES.pop(index_file, None)
+            return None
+
+        # 缓存 (索引mtime, 表)；格式过旧的索引也缓存为None，避免每次查找都重新读取
+        cached = _FORGETTING_TABLES.get(index_file)
+        if cached is None or cached[0] != index_mtime_ns:
+            try:
+                table = ForgettingTable(index_file)
+            except ValueError as e:
+                table = None
+                print(f"⚠️  {e}，请重新构建: python forgetting.py --dataset {dataset}")
+            cached = _FORGETTING_TABLES[index_file] = (index_mtime_ns, table)
+        return cached[1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='构建forgetting状态索引')
+    parser.add_argument('--dataset', type=str, nargs='+', required=True, help='数据集名称')
+    parser.add_argument('--session-dir', type=str, default=SESSION_DIR, help='session目录')
+    args = parser.parse_args()
+
+    for dataset in args.dataset:
+        build_forgetting_index(dataset, args.session_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,253 @@
+"""
+TASA模型服务
+单个进程持有BGE-M3和reranker，通过Unix socket为多个客户端（TASARAG、bank构建worker）提供encode/rerank，
+并在max-wait期限内把并发请求合并成一个micro-batch
+
+启动:
+    python model_server.py
+"""
+
+import itertools
+import os
+import queue
+import threading
+import time
+import numpy as np
+from multiprocessing.connection import Listener, Client
+from typing import List, Dict
+
+from tasa_config import *
+
+MODEL_SERVER_AUTHKEY = b"tasa-model-server"
+
+
+class _Request:
+    """一个客户端请求（items是若干条文本或若干个pair）"""
+
+    __slots__ = ('conn', 'send_lock', 'req_id', 'items')
+
+    def __init__(self, conn, send_lock, req_id, items):
+        self.conn = conn
+        self.send_lock = send_lock
+        self.req_id = req_id
+        self.items = items
+
+    def reply(self, result, error=None):
+        try:
+            with self.send_lock:
+                self.conn.send((self.req_id, result, error))
+        except (EOFError, OSError):
+            pass  # 客户端已断开
+
+
+class MicroBatcher(threading.Thread):
+    """
+    动态micro-batching：拿到第一个请求后最多再等max_wait秒，
+    期间到达的请求合并成一批（直到max_batch_size条），一次调用模型后按请求拆分结果
+    """
+
+    def __init__(self, name: str, run_batch, max_batch_size: int, max_wait: float):
+        super().__init__(name=name, daemon=True)
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.num_batches = 0
+        self.num_items = 0
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            num_items = len(batch[0].items)
+            deadline = time.monotonic() + self.max_wait
+
+            while num_items < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                num_items += len(request.items)
+
+            items = [item for request in batch for item in request.items]
+            try:
+                outputs = self.run_batch(items)
+                error = None
+            except Exception as e:
+                print(f"⚠️ {self.name} batch失败: {e}")
+                outputs, error = None, repr(e)
+
+            self.num_batches += 1
+            self.num_items += len(items)
+
+            offset = 0
+            for request in batch:
+                count = len(request.items)
+                request.reply(outputs[offset:offset + count] if error is None else None, error)
+                offset += count
+
+
+class ModelServer:
+    def __init__(self, socket_path: str = MODEL_SERVER_SOCKET,
+                 max_batch_size: int = MODEL_SERVER_MAX_BATCH,
+                 max_wait_ms: float = MODEL_SERVER_MAX_WAIT_MS,
+                 device: str = None):
+        """初始化模型服务（加载一份embedding和reranker模型）"""
+        from tasa_backends import select_device, backend_variant, load_embedder, load_reranker
+
+        print("🔧 初始化TASA模型服务...")
+
+        self.socket_path = socket_path
+        self.device = device or select_device()
+        self.variant = backend_variant(self.device)
+
+        print(f"   加载Embedding模型: {EMBEDDING_MODEL} ({self.variant})")
+        self.embed_model = load_embedder(self.device, local=True)
+
+        print(f"   加载Reranker模型: {RERANKER_MODEL} ({self.variant})")
+        self.reranker = load_reranker(self.device, local=True)
+
+        max_wait = max_wait_ms / 1000
+        self.batchers = {
+            'encode': MicroBatcher('encode', self._encode_batch, max_batch_size, max_wait),
+            'rerank': MicroBatcher('rerank', self._rerank_batch, max_batch_size, max_wait),
+        }
+        self.max_batch_size = max_batch_size
+
+        print(f"✅ TASA模型服务初始化完成 (batch={max_batch_size}, max_wait={max_wait_ms}ms)")
+
+    def _encode_batch(self, texts: List[str]) -> np.ndarray:
+        dense = self.embed_model.encode(texts, batch_size=min(len(texts), self.max_batch_size))['dense_vecs']
+        return np.asarray(dense, dtype=np.float32).reshape(len(texts), -1)
+
+    def _rerank_batch(self, pairs: List[List[str]]) -> np.ndarray:
+        # 返回未归一化的分数，由客户端按需做sigmoid，这样不同normalize参数的请求也能合批
+        scores = self.reranker.compute_score(pairs, normalize=False)
+        return np.atleast_1d(np.asarray(scores, dtype=np.float64))
+
+    def _handle_client(self, conn):
+        send_lock = threading.Lock()
+        try:
+            while True:
+                req_id, op, items = conn.recv()
+                if op == 'info':
+                    _Request(conn, send_lock, req_id, None).reply({'variant': self.variant, 'stats': self.stats()})
+                elif op in self.batchers:
+                    self.batchers[op].queue.put(_Request(conn, send_lock, req_id, items))
+                else:
+                    _Request(conn, send_lock, req_id, None).reply(None, f"Unknown op: {op}")
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+    def stats(self) -> Dict:
+        return {
+            op: {'batches': batcher.num_batches, 'items': batcher.num_items,
+                 'avg_batch': batcher.num_items / batcher.num_batches if batcher.num_batches else 0.0}
+            for op, batcher in self.batchers.items()
+        }
+
+    def serve_forever(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+        for batcher in self.batchers.values():
+            batcher.start()
+
+        listener = Listener(self.socket_path, family='AF_UNIX', authkey=MODEL_SERVER_AUTHKEY)
+        print(f"🚀 模型服务监听: {self.socket_path}")
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self._handle_client, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+
+
+class ModelServerClient:
+    """
+    模型服务客户端，接口与BGEM3FlagModel.encode / FlagReranker.compute_score兼容，可直接替换本地模型
+
+    同一个客户端可以被多个线程并发使用：请求按id分发，后台线程接收响应
+    """
+
+    def __init__(self, socket_path: str = MODEL_SERVER_SOCKET, timeout: float = MODEL_SERVER_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.conn = Client(socket_path, family='AF_UNIX', authkey=MODEL_SERVER_AUTHKEY)
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        
+        # 服务端的后端变体（用于区分缓存）
+        self.variant = f"server-{self.info()['variant']}"
+
+    def _read_loop(self):
+        try:
+            while True:
+                req_id, result, error = self.conn.recv()
+                with self._pending_lock:
+                    slot = self._pending.pop(req_id, None)
+                if slot is not None:
+                    slot['result'], slot['error'] = result, error
+                    slot['event'].set()
+        except (EOFError, OSError):
+            self._closed = True
+            with self._pending_lock:
+                pending, self._pending = self._pending, {}
+            for slot in pending.values():
+                slot['error'] = "Model server connection closed"
+                slot['event'].set()
+
+    def _call(self, op: str, items):
+        if self._closed:
+            raise ConnectionError(f"Model server connection closed: {self.socket_path}")
+
+        req_id = next(self._ids)
+        slot = {'event': threading.Event(), 'result': None, 'error': None}
+        with self._pending_lock:
+            self._pending[req_id] = slot
+        with self._send_lock:
+            self.conn.send((req_id, op, items))
+
+        if not slot['event'].wait(self.timeout):
+            with self._pending_lock:
+                self._pending.pop(req_id, None)
+            raise TimeoutError(f"Model server {op} timed out after {self.timeout}s")
+        if slot['error'] is not None:
+            raise RuntimeError(f"Model server {op} failed: {slot['error']}")
+        return slot['result']
+
+    def encode(self, sentences, batch_size: int = None, **kwargs) -> Dict:
+        """与BGEM3FlagModel.encode相同：返回 {'dense_vecs': ...}"""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        dense = np.asarray(self._call('encode', texts), dtype=np.float32)
+        return {'dense_vecs': dense[0] if single else dense}
+
+    def compute_score(self, sentence_pairs, normalize: bool = False, **kwargs):
+        """与FlagReranker.compute_score相同：normalize=True时返回sigmoid后的分数"""
+        single = isinstance(sentence_pairs[0], str)
+        pairs = [list(sentence_pairs)] if single else [list(pair) for pair in sentence_pairs]
+        scores = np.asarray(self._call('rerank', pairs), dtype=np.float64)
+        if normalize:
+            scores = 1 / (1 + np.exp(-scores))
+        scores = scores.tolist()
+        return scores[0] if single else scores
+
+    def info(self) -> Dict:
+        return self._call('info', None)
+
+    def close(self):
+        self.conn.close()
+
+
+if __name__ == "__main__":
+    ModelServer().serve_forever()
@@ -6,25 +6,163 @@ TASA RAG模块
 import json
 import numpy as np
 from typing import List, Dict, Tuple
-from FlagEmbedding import BGEM3FlagModel, FlagReranker
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 
 from tasa_config import *
+from tasa_backends import select_device, model_variant, load_embedder, load_reranker
+from tasa_cache import QueryEmbeddingCache, RerankScoreCache
+from tasa_bank import BANK_CACHE, load_student_bank, normalize_query, hybrid_scores, top_k_indices, top_reranked
 
-class TASARAG:
+class RetrievalBatcher(threading.Thread):
+    """
+    跨session的检索批处理：多个session同一轮的retrieve_and_rerank请求在max_wait内合并，
+    一次encode所有query、一次reranker batch精排所有候选，再把结果分发回各个session
+    """
+    
+    def __init__(self, rag, max_batch_size: int = RAG_BATCH_MAX_SESSIONS,
+                 max_wait_ms: float = RAG_BATCH_MAX_WAIT_MS):
+        super().__init__(name='tasa-rag-batcher', daemon=True)
+        self.rag = rag
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue = queue.Queue()
+        self.num_batches = 0
+        self.num_requests = 0
+    
+    def submit(self, query: str, student_id: int, dataset: str, concept_text: str) -> Future:
+        future = Future()
+        self.queue.put(((query, student_id, dataset, concept_text), future))
+        return future
+    
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            
+            self.num_batches += 1
+            self.num_requests += len(batch)
+            try:
+                results = self.rag.retrieve_and_rerank_many([request for request, _ in batch],
+                                                            return_exceptions=True)
+            except Exception as e:
+                # 整批失败（如query编码/reranker出错）
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            # 单个请求失败（如某个学生的bank缺失）只影响该请求
+            for (_, future), result in zip(batch, results):
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+    
+    def stats(self) -> Dict:
+        return {
+            'batches': self.num_batches,
+            'requests': self.num_requests,
+            'avg_batch': self.num_requests / self.num_batches if self.num_batches else 0.0,
+        }
+
+
+class TASARAGBase:
+    """
+    TASARAG和TASARAGLambda共用的部分：模型加载、query/rerank缓存、编码与精排
+    """
+    
     def __init__(self):
-        """初始化RAG模块"""
-        print("🔧 初始化TASA RAG模块...")
+        # 自动选择推理设备（GPU: fp16, CPU: int8量化/fp32；INFERENCE_BACKEND="server"时使用共享模型服务）
+        self.device = select_device()
         
-        # 加载embedding模型 (使用GPU)
+        # 加载embedding模型
         print(f"   加载Embedding模型: {EMBEDDING_MODEL}")
-        self.embed_model = BGEM3FlagModel(EMBEDDING_MODEL, use_fp16=True, device='cuda')
+        self.embed_model = load_embedder(self.device)
         
-        # 加载reranker模型 (使用GPU)
+        # 加载reranker模型
         print(f"   加载Reranker模型: {RERANKER_MODEL}")
-        self.reranker = FlagReranker(RERANKER_MODEL, use_fp16=True, device='cuda')
+        self.reranker = load_reranker(self.device)
+        
+        self.variant = model_variant(self.embed_model, self.device)
+        
+        # 已解码学生bank的LRU缓存（进程内共享）
+        self.bank_cache = BANK_CACHE
         
-        print("✅ TASA RAG模块初始化完成 (GPU加速)")
+        # Query embedding缓存（相同query不再经过模型）
+        self.query_cache = QueryEmbeddingCache(self.embed_model, model_name=f"{EMBEDDING_MODEL}:{self.variant}")
+        
+        # Reranker分数缓存（只对未缓存的 (query, description) 调用reranker）
+        self.rerank_cache = RerankScoreCache(self.reranker, model_name=f"{RERANKER_MODEL}:{self.variant}")
+        
+        # encode和rerank各自加锁：多个会话共享同一实例时，一个会话的rerank可以与另一个会话的encode重叠
+        self._encode_lock = threading.Lock()
+        self._rerank_lock = threading.Lock()
+        # 加载学生bank（可能读盘）与query编码并行
+        self._io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='tasa-bank')
+    
+    def load_bank_and_encode(self, query: str, student_id: int, dataset: str, concept_text: str) -> Tuple[np.ndarray, Dict]:
+        """后台加载学生数据（LRU缓存，重复轮次不再读盘），同时编码query"""
+        bank_future = self._io_pool.submit(load_student_bank, student_id, dataset, concept_text, self.bank_cache)
+        query_emb = self.encode_query(query)
+        return query_emb, bank_future.result()
+    
+    def encode_query(self, query: str) -> np.ndarray:
+        """编码query（经过缓存，只归一化一次）"""
+        with self._encode_lock:
+            return normalize_query(self.query_cache.encode(query))
+    
+    def rerank_scores_fused(self, query: str, persona_candidates: List[Dict],
+                            memory_candidates: List[Dict]) -> Tuple[List[float], List[float]]:
+        """persona和memory候选合并成一个batch调用一次reranker（只用description），再按位置拆分分数"""
+        candidates = persona_candidates + memory_candidates
+        if len(candidates) == 0:
+            return [], []
+        
+        pairs = [[query, item['description']] for item in candidates]
+        with self._rerank_lock:
+            rerank_scores = self.rerank_cache.compute_score(pairs)
+        
+        n_persona = len(persona_candidates)
+        return rerank_scores[:n_persona], rerank_scores[n_persona:]
+    
+    def rerank_fused(self, query: str, persona_candidates: List[Dict],
+                     memory_candidates: List[Dict]) -> Tuple[List[Dict], List[Dict]]:
+        """
+        persona和memory候选一次性精排
+        
+        Returns:
+            top_persona, top_memory: 各自的top TOP_K_RERANK
+        """
+        persona_scores, memory_scores = self.rerank_scores_fused(query, persona_candidates, memory_candidates)
+        return (top_reranked(persona_scores, persona_candidates),
+                top_reranked(memory_scores, memory_candidates))
+    
+    def rerank(self, query: str, candidates: List[Dict]) -> List[Dict]:
+        """使用reranker按description精排候选，返回top TOP_K_RERANK"""
+        return self.rerank_fused(query, candidates, [])[0]
+
+
+class TASARAG(TASARAGBase):
+    def __init__(self):
+        """初始化RAG模块"""
+        print("🔧 初始化TASA RAG模块...")
+        super().__init__()
+        
+        # 跨session检索批处理（enable_batching()后启用）
+        self.batcher = None
+        
+        print(f"✅ TASA RAG模块初始化完成 ({self.variant})")
     
     def load_student_data(self, student_id: int, dataset: str, concept_text: str) -> Tuple[List[Dict], List[Dict]]:
         """
@@ -34,58 +172,8 @@ class TASARAG:
             persona_items: List of {description, keywords, description_emb, keywords_emb, stats, ...}
             memory_items: List of {description, keywords, description_emb, keywords_emb, timestamp, ...}
         """
-        # 加载persona
-        persona_file = f"{PERSONA_DIR}/{dataset}/data/{student_id}.json"
-        with open(persona_file) as f:
-            persona_data = json.load(f)
-        
-        # 加载persona embeddings
-        persona_desc_emb_file = f"{PERSONA_DIR}/{dataset}/embeddings/{student_id}_description.npz"
-        persona_kw_emb_file = f"{PERSONA_DIR}/{dataset}/embeddings/{student_id}_keywords.npz"
-        
-        persona_desc_embs = np.load(persona_desc_emb_file, allow_pickle=True)['embeddings']
-        persona_kw_embs = np.load(persona_kw_emb_file, allow_pickle=True)['embeddings']
-        
-        # 组装persona items
-        persona_items = []
-        for i, concept_data in enumerate(persona_data):
-            if concept_data['concept_text'] == concept_text:
-                # 只加载相关concept的persona（但实际上我们可能想要所有相关的）
-                pass
-            persona_items.append({
-                'concept_text': concept_data['concept_text'],
-                'description': concept_data['description'],
-                'keywords': concept_data['keywords'],
-                'description_emb': persona_desc_embs[i],
-                'keywords_emb': persona_kw_embs[i],
-                'stats': concept_data['stats']
-            })
-        
-        # 加载memory
-        memory_file = f"{MEMORY_DIR}/{dataset}/data/{student_id}.json"
-        with open(memory_file) as f:
-            memory_data = json.load(f)
-        
-        # 加载memory embeddings
-        memory_desc_emb_file = f"{MEMORY_DIR}/{dataset}/embeddings/{student_id}_description.npz"
-        memory_desc_embs = np.load(memory_desc_emb_file)['embeddings']
-        
-        # 注意：memory可能没有keywords embeddings，我们只用description
-        memory_items = []
-        for i, mem in enumerate(memory_data):
-            if mem['concept_text'] == concept_text:
-                # 只保留目标concept的memory
-                memory_items.append({
-                    'concept_text': mem['concept_text'],
-                    'description': mem['description'],
-                    'keywords': mem.get('keywords', mem['description']),  # 如果没有keywords用description
-                    'description_emb': memory_desc_embs[i],
-                    'keywords_emb': memory_desc_embs[i],  # memory可能没有单独的keywords embedding
-                    'timestamp': mem.get('timestamp', 0),
-                    'response': mem.get('response', 0)
-                })
-        
-        return persona_items, memory_items
+        bank = load_student_bank(student_id, dataset, concept_text, cache=self.bank_cache)
+        return bank['persona_items'], bank['memory_items']
     
     def compute_similarity(self, query_emb: np.ndarray, desc_emb: np.ndarray, 
                           kw_emb: np.ndarray, lambda_weight: float = LAMBDA_WEIGHT) -> float:
@@ -99,63 +187,99 @@ class TASARAG:
         total_score = lambda_weight * sim_desc + (1 - lambda_weight) * sim_kw
         return float(total_score)
     
+    def enable_batching(self, max_batch_size: int = RAG_BATCH_MAX_SESSIONS,
+                        max_wait_ms: float = RAG_BATCH_MAX_WAIT_MS):
+        """启用跨session批处理：之后并发的retrieve_and_rerank调用会被合并成批"""
+        if self.batcher is None:
+            self.batcher = RetrievalBatcher(self, max_batch_size, max_wait_ms)
+            self.batcher.start()
+        return self.batcher
+    
+    def retrieve_and_rerank_many(self, requests: List[Tuple[str, int, str, str]],
+                                 return_exceptions: bool = False) -> List[Tuple[List[Dict], List[Dict]]]:
+        """
+        批量RAG检索并重排
+        
+        Args:
+            requests: List of (query, student_id, dataset, concept_text)
+            return_exceptions: 为True时，加载bank失败的请求在结果中返回异常（不参与精排），其他请求正常返回；
+                               为False时直接抛出第一个失败请求的异常
+        
+        Returns:
+            与requests顺序一致的 (top_persona, top_memory)
+        """
+        # 1. 后台加载所有学生数据，同时一次编码所有query
+        bank_futures = [self._io_pool.submit(load_student_bank, student_id, dataset, concept_text, self.bank_cache)
+                        for _, student_id, dataset, concept_text in requests]
+        with self._encode_lock:
+            query_embs = [normalize_query(emb) for emb in
+                          self.query_cache.encode_many([query for query, _, _, _ in requests])]
+        
+        # 2. 每个请求各自做向量化粗排（加载失败的请求记录异常，不进入精排batch）
+        candidates = []
+        errors = {}
+        for n, (query_emb, bank_future) in enumerate(zip(query_embs, bank_futures)):
+            try:
+                bank = bank_future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                errors[n] = e
+                candidates.append(([], []))
+                continue
+            persona_scores = hybrid_scores(query_emb, bank['persona_desc'], bank['persona_kw'])
+            memory_scores = hybrid_scores(query_emb, bank['memory_desc'], bank['memory_kw'])
+            candidates.append((
+                [bank['persona_items'][i] for i in top_k_indices(persona_scores, TOP_K_RETRIEVE)],
+                [bank['memory_items'][i] for i in top_k_indices(memory_scores, TOP_K_RETRIEVE)],
+            ))
+        
+        # 3. 所有请求的persona和memory候选合并成一个reranker batch
+        pairs = [[query, item['description']]
+                 for (query, _, _, _), (persona, memory) in zip(requests, candidates)
+                 for item in persona + memory]
+        with self._rerank_lock:
+            rerank_scores = self.rerank_cache.compute_score(pairs)
+        
+        results = []
+        offset = 0
+        for n, (persona, memory) in enumerate(candidates):
+            persona_scores = rerank_scores[offset:offset + len(persona)]
+            offset += len(persona)
+            memory_scores = rerank_scores[offset:offset + len(memory)]
+            offset += len(memory)
+            if n in errors:
+                results.append(errors[n])
+            else:
+                results.append((top_reranked(persona_scores, persona), top_reranked(memory_scores, memory)))
+        
+        return results
+    
     def retrieve_and_rerank(self, query: str, student_id: int, dataset: str, 
                            concept_text: str) -> Tuple[List[Dict], List[Dict]]:
         """
-        RAG检索并重排
+        RAG检索并重排（启用批处理时与其他session的同轮请求合并）
         
         Returns:
             top_persona: Top 3 persona items
             top_memory: Top 3 memory items
         """
-        # 1. 编码query
-        query_emb = self.embed_model.encode(query)['dense_vecs']
-        
-        # 2. 加载学生数据
-        persona_items, memory_items = self.load_student_data(student_id, dataset, concept_text)
-        
-        # 3. 计算persona相似度并排序
-        persona_scores = []
-        for item in persona_items:
-            score = self.compute_similarity(query_emb, item['description_emb'], item['keywords_emb'])
-            persona_scores.append((score, item))
-        
-        # 取top-K
-        persona_scores.sort(key=lambda x: x[0], reverse=True)
-        top_k_persona = persona_scores[:TOP_K_RETRIEVE]
-        
-        # 4. 计算memory相似度并排序
-        memory_scores = []
-        for item in memory_items:
-            score = self.compute_similarity(query_emb, item['description_emb'], item['keywords_emb'])
-            memory_scores.append((score, item))
-        
-        memory_scores.sort(key=lambda x: x[0], reverse=True)
-        top_k_memory = memory_scores[:TOP_K_RETRIEVE]
-        
-        # 5. 使用reranker精排persona（只用description）
-        if len(top_k_persona) > 0:
-            persona_pairs = [[query, item['description']] for _, item in top_k_persona]
-            persona_rerank_scores = self.reranker.compute_score(persona_pairs, normalize=True)
-            
-            # 重新排序
-            persona_reranked = list(zip(persona_rerank_scores, [item for _, item in top_k_persona]))
-            persona_reranked.sort(key=lambda x: x[0], reverse=True)
-            top_persona = [item for _, item in persona_reranked[:TOP_K_RERANK]]
-        else:
-            top_persona = []
-        
-        # 6. 使用reranker精排memory
-        if len(top_k_memory) > 0:
-            memory_pairs = [[query, item['description']] for _, item in top_k_memory]
-            memory_rerank_scores = self.reranker.compute_score(memory_pairs, normalize=True)
-            
-            # 重新排序
-            memory_reranked = list(zip(memory_rerank_scores, [item for _, item in top_k_memory]))
-            memory_reranked.sort(key=lambda x: x[0], reverse=True)
-            top_memory = [item for _, item in memory_reranked[:TOP_K_RERANK]]
-        else:
-            top_memory = []
+        if self.batcher is not None:
+            return self.batcher.submit(query, student_id, dataset, concept_text).result()
+        
+        # 1. 后台加载学生数据（LRU缓存，重复轮次不再读盘），同时编码query
+        query_emb, bank = self.load_bank_and_encode(query, student_id, dataset, concept_text)
+        
+        # 2. persona: 一次矩阵-向量乘法打分，部分选择取top-K
+        persona_scores = hybrid_scores(query_emb, bank['persona_desc'], bank['persona_kw'])
+        top_k_persona = [bank['persona_items'][i] for i in top_k_indices(persona_scores, TOP_K_RETRIEVE)]
+        
+        # 3. memory
+        memory_scores = hybrid_scores(query_emb, bank['memory_desc'], bank['memory_kw'])
+        top_k_memory = [bank['memory_items'][i] for i in top_k_indices(memory_scores, TOP_K_RETRIEVE)]
+        
+        # 4. persona和memory合并成一个batch精排（只用description）
+        top_persona, top_memory = self.rerank_fused(query, top_k_persona, top_k_memory)
         
         return top_persona, top_memory
 
@@ -180,4 +304,8 @@ if __name__ == "__main__":
     print(f"\nTop 3 Memory:")
     for i, item in enumerate(top_memory, 1):
         print(f"{i}. {item['description']}")
+    
+    print(f"\nBank缓存: {rag.bank_cache.stats()}")
+    print(f"Query缓存: {rag.query_cache.stats()}")
+    print(f"Rerank缓存: {rag.rerank_cache.stats()}")
 
@@ -6,13 +6,14 @@ TASA RAG模块 - Lambda可配置版本
 import json
 import numpy as np
 from typing import List, Dict, Tuple
-from FlagEmbedding import BGEM3FlagModel, FlagReranker
 import os
 
 from tasa_config import *
+from tasa_rag import TASARAGBase
+from tasa_bank import load_student_bank, hybrid_scores, similarity_vectors, top_k_indices, top_reranked
 
-class TASARAGLambda:
-    """支持自定义lambda的RAG模块"""
+class TASARAGLambda(TASARAGBase):
+    """支持自定义lambda的RAG模块（retrieve_and_rerank_sweep可一次完成多个lambda）"""
     
     def __init__(self, lambda_weight: float = None):
         """
@@ -25,65 +26,14 @@ class TASARAGLambda:
         
         self.lambda_weight = lambda_weight if lambda_weight is not None else LAMBDA_WEIGHT
         
-        # 加载embedding模型 (使用GPU)
-        print(f"   加载Embedding模型: {EMBEDDING_MODEL}")
-        self.embed_model = BGEM3FlagModel(EMBEDDING_MODEL, use_fp16=True, device='cuda')
+        super().__init__()
         
-        # 加载reranker模型 (使用GPU)
-        print(f"   加载Reranker模型: {RERANKER_MODEL}")
-        self.reranker = FlagReranker(RERANKER_MODEL, use_fp16=True, device='cuda')
-        
-        print(f"✅ TASA RAG模块初始化完成 (GPU加速, Lambda={self.lambda_weight})")
+        print(f"✅ TASA RAG模块初始化完成 ({self.variant}, Lambda={self.lambda_weight})")
     
     def load_student_data(self, student_id: int, dataset: str, concept_text: str) -> Tuple[List[Dict], List[Dict]]:
         """加载学生的persona和memory数据"""
-        # 加载persona
-        persona_file = f"{PERSONA_DIR}/{dataset}/data/{student_id}.json"
-        with open(persona_file) as f:
-            persona_data = json.load(f)
-        
-        # 加载persona embeddings
-        persona_desc_emb_file = f"{PERSONA_DIR}/{dataset}/embeddings/{student_id}_description.npz"
-        persona_kw_emb_file = f"{PERSONA_DIR}/{dataset}/embeddings/{student_id}_keywords.npz"
-        
-        persona_desc_embs = np.load(persona_desc_emb_file, allow_pickle=True)['embeddings']
-        persona_kw_embs = np.load(persona_kw_emb_file, allow_pickle=True)['embeddings']
-        
-        # 组装persona items
-        persona_items = []
-        for i, concept_data in enumerate(persona_data):
-            persona_items.append({
-                'concept_text': concept_data['concept_text'],
-                'description': concept_data['description'],
-                'keywords': concept_data['keywords'],
-                'description_emb': persona_desc_embs[i],
-                'keywords_emb': persona_kw_embs[i],
-                'stats': concept_data['stats']
-            })
-        
-        # 加载memory
-        memory_file = f"{MEMORY_DIR}/{dataset}/data/{student_id}.json"
-        with open(memory_file) as f:
-            memory_data = json.load(f)
-        
-        # 加载memory embeddings
-        memory_desc_emb_file = f"{MEMORY_DIR}/{dataset}/embeddings/{student_id}_description.npz"
-        memory_desc_embs = np.load(memory_desc_emb_file)['embeddings']
-        
-        memory_items = []
-        for i, mem in enumerate(memory_data):
-            if mem['concept_text'] == concept_text:
-                memory_items.append({
-                    'concept_text': mem['concept_text'],
-                    'description': mem['description'],
-                    'keywords': mem.get('keywords', mem['description']),
-                    'description_emb': memory_desc_embs[i],
-                    'keywords_emb': memory_desc_embs[i],
-                    'timestamp': mem.get('timestamp', 0),
-                    'response': mem.get('response', 0)
-                })
-        
-        return persona_items, memory_items
+        bank = load_student_bank(student_id, dataset, concept_text, cache=self.bank_cache)
+        return bank['persona_items'], bank['memory_items']
     
     def compute_similarity(self, query_emb: np.ndarray, desc_emb: np.ndarray, 
                           kw_emb: np.ndarray) -> float:
@@ -107,51 +57,72 @@ class TASARAGLambda:
             top_persona: Top 3 persona items
             top_memory: Top 3 memory items
         """
-        # 1. 编码query
-        query_emb = self.embed_model.encode(query)['dense_vecs']
-        
-        # 2. 加载学生数据
-        persona_items, memory_items = self.load_student_data(student_id, dataset, concept_text)
-        
-        # 3. 计算persona相似度并排序
-        persona_scores = []
-        for item in persona_items:
-            score = self.compute_similarity(query_emb, item['description_emb'], item['keywords_emb'])
-            persona_scores.append((score, item))
-        
-        persona_scores.sort(key=lambda x: x[0], reverse=True)
-        top_k_persona = persona_scores[:TOP_K_RETRIEVE]
-        
-        # 4. 计算memory相似度并排序
-        memory_scores = []
-        for item in memory_items:
-            score = self.compute_similarity(query_emb, item['description_emb'], item['keywords_emb'])
-            memory_scores.append((score, item))
-        
-        memory_scores.sort(key=lambda x: x[0], reverse=True)
-        top_k_memory = memory_scores[:TOP_K_RETRIEVE]
-        
-        # 5. 使用reranker精排persona
-        if len(top_k_persona) > 0:
-            persona_pairs = [[query, item['description']] for _, item in top_k_persona]
-            persona_rerank_scores = self.reranker.compute_score(persona_pairs, normalize=True)
-            
-            persona_reranked = list(zip(persona_rerank_scores, [item for _, item in top_k_persona]))
-            persona_reranked.sort(key=lambda x: x[0], reverse=True)
-            top_persona = [item for _, item in persona_reranked[:TOP_K_RERANK]]
-        else:
-            top_persona = []
-        
-        # 6. 使用reranker精排memory
-        if len(top_k_memory) > 0:
-            memory_pairs = [[query, item['description']] for _, item in top_k_memory]
-            memory_rerank_scores = self.reranker.compute_score(memory_pairs, normalize=True)
-            
-            memory_reranked = list(zip(memory_rerank_scores, [item for _, item in top_k_memory]))
-            memory_reranked.sort(key=lambda x: x[0], reverse=True)
-            top_memory = [item for _, item in memory_reranked[:TOP_K_RERANK]]
-        else:
-            top_memory = []
+        # 1. 后台加载学生数据（LRU缓存，重复轮次不再读盘），同时编码query
+        query_emb, bank = self.load_bank_and_encode(query, student_id, dataset, concept_text)
+        
+        # 2. 向量化计算persona相似度，部分选择取top-K
+        persona_scores = hybrid_scores(query_emb, bank['persona_desc'], bank['persona_kw'], self.lambda_weight)
+        top_k_persona = [bank['persona_items'][i] for i in top_k_indices(persona_scores, TOP_K_RETRIEVE)]
+        
+        # 3. 向量化计算memory相似度
+        memory_scores = hybrid_scores(query_emb, bank['memory_desc'], bank['memory_kw'], self.lambda_weight)
+        top_k_memory = [bank['memory_items'][i] for i in top_k_indices(memory_scores, TOP_K_RETRIEVE)]
+        
+        # 4. persona和memory合并成一个batch精排
+        top_persona, top_memory = self.rerank_fused(query, top_k_persona, top_k_memory)
         
         return top_persona, top_memory
-
+    
+    def retrieve_and_rerank_sweep(self, query: str, student_id: int, dataset: str,
+                                  concept_text: str, lambdas: List[float]) -> Dict[float, Dict]:
+        """
+        一次检索完成多个lambda的ablation
+        
+        sim_desc和sim_kw与lambda无关，只计算一次；各lambda的top-K候选取并集后只精排一次，
+        再按各自的候选集合复用reranker分数
+        
+        Returns:
+            results: {lambda: {
+                'ranked_persona': top-K persona (按hybrid分数), 'ranked_memory': top-K memory,
+                'top_persona': 精排后的top persona, 'top_memory': 精排后的top memory
+            }}
+        """
+        # 1. 后台加载学生数据，同时编码query
+        query_emb, bank = self.load_bank_and_encode(query, student_id, dataset, concept_text)
+        
+        # 2. 与lambda无关的相似度向量只算一次
+        persona_sims = similarity_vectors(query_emb, bank['persona_desc'], bank['persona_kw'])
+        memory_sims = similarity_vectors(query_emb, bank['memory_desc'], bank['memory_kw'])
+        
+        # 3. 每个lambda的top-K下标
+        ranked = {}
+        for lambda_weight in lambdas:
+            persona_scores = lambda_weight * persona_sims[0] + (1 - lambda_weight) * persona_sims[1]
+            memory_scores = lambda_weight * memory_sims[0] + (1 - lambda_weight) * memory_sims[1]
+            ranked[lambda_weight] = (top_k_indices(persona_scores, TOP_K_RETRIEVE),
+                                     top_k_indices(memory_scores, TOP_K_RETRIEVE))
+        
+        # 4. 所有lambda的候选取并集，一次精排
+        persona_pool = sorted({int(i) for persona_idx, _ in ranked.values() for i in persona_idx})
+        memory_pool = sorted({int(i) for _, memory_idx in ranked.values() for i in memory_idx})
+        persona_rerank, memory_rerank = self.rerank_scores_fused(
+            query,
+            [bank['persona_items'][i] for i in persona_pool],
+            [bank['memory_items'][i] for i in memory_pool]
+        )
+        persona_rerank = dict(zip(persona_pool, persona_rerank))
+        memory_rerank = dict(zip(memory_pool, memory_rerank))
+        
+        # 5. 按各lambda的候选集合复用分数重排
+        results = {}
+        for lambda_weight, (persona_idx, memory_idx) in ranked.items():
+            ranked_persona = [bank['persona_items'][i] for i in persona_idx]
+            ranked_memory = [bank['memory_items'][i] for i in memory_idx]
+            results[lambda_weight] = {
+                'ranked_persona': ranked_persona,
+                'ranked_memory': ranked_memory,
+                'top_persona': top_reranked([persona_rerank[int(i)] for i in persona_idx], ranked_persona),
+                'top_memory': top_reranked([memory_rerank[int(i)] for i in memory_idx], ranked_memory),
+            }
+        
+        return results
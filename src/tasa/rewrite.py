@@ -4,89 +4,103 @@ TASA Mastery Rewrite模块
 """
 
 import json
-from typing import List, Dict, Tuple
-from openai import OpenAI
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Tuple, Optional
 
 from tasa_config import *
+from tasa_cache import RewriteCache
+from llm_client_unified import get_openai_client, get_single_flight, request_key, reraise_cache_miss
+from tasa_forgetting import get_forgetting_table, session_row, row_state
+
+
+def rewrite_store_path(dataset: str) -> str:
+    """离线预计算重写结果的存储路径（与bank放在一起）"""
+    return f"{REWRITE_STORE_DIR}/{dataset}/rewrites.sqlite"
+
 
 class MasteryRewriter:
     def __init__(self):
         """初始化Mastery重写模块"""
         print("🔧 初始化Mastery Rewriter...")
         
-        self.client = OpenAI(
-            api_key=API_KEY,
-            base_url=ENDPOINT
-        )
+        # 进程内共享的OpenAI客户端（keep-alive连接池）
+        self.client = get_openai_client(API_KEY, ENDPOINT)
+        
+        # 同一轮的persona/memory重写并发发出（有界线程池；多session共享时用set_max_workers扩大）
+        self.pool = ThreadPoolExecutor(max_workers=REWRITE_MAX_WORKERS, thread_name_prefix='tasa-rewrite')
+        
+        # 重写结果持久化缓存（相同输入+模型+temperature不再重复调用LLM）
+        self.cache = RewriteCache() if REWRITE_CACHE_PATH else None
+        
+        # 离线预计算的重写结果（每个数据集一个，按需打开）
+        self.stores = {}
+        self._stores_lock = threading.Lock()
         
         print("✅ Mastery Rewriter初始化完成")
     
+    def set_max_workers(self, max_workers: int):
+        """
+        调整重写线程池大小。多个session共享一个MasteryRewriter时，REWRITE_MAX_WORKERS是所有session合计的上限，
+        应扩大到与rewrite endpoint的并发上限一致，由endpoint限流决定实际并发
+        """
+        old_pool = self.pool
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tasa-rewrite')
+        old_pool.shutdown(wait=False)
+    
     def load_forgetting_info(self, student_id: int, dataset: str, concept_text: str) -> Dict:
-        """加载学生的forgetting curve信息"""
-        session_file = f"{SESSION_DIR}/{dataset}/{student_id}.json"
-        
-        with open(session_file) as f:
-            session = json.load(f)
-        
-        # 提取forgetting信息
-        delta_t_minutes = session.get('delta_t_minutes', 0)
-        delta_t_days = delta_t_minutes / (24 * 60)  # 转换为天数
-        
-        # 计算forgetting score
-        # 根据FORGETTING_SCORE_METHOD从session中提取对应method的FS
-        from tasa_config import FORGETTING_SCORE_METHOD
-        
-        if FORGETTING_SCORE_METHOD == "simple_time":
-            # 使用简单时间衰减公式：F(t) = 1 - 1/(1 + t/7)  (7天半遗忘)
-            forgetting_score = 1 - 1 / (1 + delta_t_days / 7)
-            forgetting_level = get_forgetting_level(forgetting_score)
-        elif FORGETTING_SCORE_METHOD in ["history", "lpkt", "dkt", "akt", "simplekt"]:
-            # 从session的methods中提取对应method的FS
-            if 'methods' in session and FORGETTING_SCORE_METHOD in session['methods']:
-                method_data = session['methods'][FORGETTING_SCORE_METHOD]
-                forgetting_score = method_data.get('fs', 0.0)
-                # 直接使用method中的level（映射：medium -> moderate, high -> high, low -> low）
-                method_level = method_data.get('level', '')
-                if method_level == 'medium':
-                    forgetting_level = 'moderate'
-                elif method_level == 'high':
-                    forgetting_level = 'high'
-                elif method_level == 'low':
-                    forgetting_level = 'low'
-                else:
-                    # 如果level不存在，不使用get_forgetting_level，而是根据FS范围判断
-                    # 根据methods的判断逻辑：high(>0.3), medium(0.15-0.3), low(<0.15)
-                    if forgetting_score > 0.3:
-                        forgetting_level = 'high'
-                    elif forgetting_score > 0.15:
-                        forgetting_level = 'moderate'
-                    else:
-                        forgetting_level = 'low'
-            else:
-                # 如果method不存在，fallback到simple_time
-                print(f"   ⚠️  Method {FORGETTING_SCORE_METHOD} not found, fallback to simple_time")
-                forgetting_score = 1 - 1 / (1 + delta_t_days / 7)
-                forgetting_level = get_forgetting_level(forgetting_score)
+        """加载学生的forgetting curve信息（从预先构建的forgetting状态表中O(1)查找）"""
+        table = get_forgetting_table(dataset)
+        
+        if table is not None and student_id in table:
+            state = table.lookup(student_id, FORGETTING_SCORE_METHOD)
         else:
-            raise ValueError(f"Unknown FORGETTING_SCORE_METHOD: {FORGETTING_SCORE_METHOD}")
+            # 索引中没有该学生（如索引构建后新增的session），直接读取session文件
+            session_file = f"{SESSION_DIR}/{dataset}/{student_id}.json"
+            with open(session_file) as f:
+                session = json.load(f)
+            state = row_state(session_row(student_id, session), FORGETTING_SCORE_METHOD)
         
-        # 获取mastery
-        mastery = session['persona']['stats']['correct'] / session['persona']['stats']['total']
+        if state['fallback']:
+            # 如果method不存在，fallback到simple_time
+            print(f"   ⚠️  Method {FORGETTING_SCORE_METHOD} not found, fallback to simple_time")
         
         return {
             'concept': concept_text,
-            'mastery': mastery,
-            'delta_t_days': delta_t_days,
-            'delta_t_minutes': delta_t_minutes,
-            'forgetting_score': forgetting_score,
-            'forgetting_level': forgetting_level  # 使用前面计算好的level，不要重新计算
+            'mastery': state['mastery'],
+            'delta_t_days': state['delta_t_days'],
+            'delta_t_minutes': state['delta_t_minutes'],
+            'forgetting_score': state['forgetting_score'],
+            'forgetting_level': state['forgetting_level']
         }
     
-    def rewrite_description(self, description: str, concept: str, 
-                           mastery: float, delta_t_days: float,
-                           forgetting_score: float, forgetting_level: str) -> str:
+    def get_precomputed_store(self, dataset: str):
         """
-        使用LLM重写description，考虑forgetting curve
+        数据集的离线预计算重写结果（不存在时返回None）
+        
+        只缓存已打开的存储：预计算在服务/runner启动之后才完成时，之后的调用会打开它
+        """
+        if not REWRITE_STORE_DIR:
+            return None
+        
+        with self._stores_lock:
+            store = self.stores.get(dataset)
+            if store is None:
+                path = rewrite_store_path(dataset)
+                if not os.path.exists(path):
+                    return None
+                store = self.stores[dataset] = RewriteCache(path, policy="reuse")
+            return store
+    
+    def request_rewrite(self, description: str, concept: str,
+                        mastery: float, delta_t_days: float,
+                        forgetting_score: float, forgetting_level: str) -> Optional[str]:
+        """
+        调用一次LLM重写description（不经过缓存，异常直接抛出）
+        
+        Returns:
+            重写后的描述，模型没有返回内容时为None
         """
         system_message = """You are a personalized math tutor. Given a student's original state for a concept, including mastery, last practice interval, and forgetting score, rewrite the description to reflect time-dependent forgetting. Output only the updated description, concise and specific to the concept."""
         
@@ -98,64 +112,229 @@ Forgetting Level: {forgetting_level} - {FORGETTING_LEVELS[forgetting_level]}
 
 Rewrite the description to reflect the current knowledge state after forgetting."""
         
-        try:
+        rewritten = self.complete([
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message}
+        ], max_tokens=300)
+        return rewritten.strip() if rewritten is not None else None
+    
+    def complete(self, messages: List[Dict], max_tokens: int) -> Optional[str]:
+        """
+        调用REWRITE_MODEL，返回message.content（异常直接抛出）
+        
+        REWRITE_SINGLE_FLIGHT开启时，同时在途的相同请求（如多个session重写同一条描述）共享一次调用；
+        rotate缓存策略需要独立样本，不合并
+        """
+        def call():
             response = self.client.chat.completions.create(
                 model=REWRITE_MODEL,
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
+                messages=messages,
                 temperature=REWRITE_TEMPERATURE,
-                max_tokens=300
+                max_tokens=max_tokens
             )
-            
-            rewritten = response.choices[0].message.content
+            return response.choices[0].message.content
+        
+        if REWRITE_SINGLE_FLIGHT and REWRITE_CACHE_POLICY != "rotate":
+            return get_single_flight().do(request_key(REWRITE_MODEL, messages, REWRITE_TEMPERATURE, max_tokens), call)
+        return call()
+    
+    def rewrite_description(self, description: str, concept: str, 
+                           mastery: float, delta_t_days: float,
+                           forgetting_score: float, forgetting_level: str) -> str:
+        """
+        使用LLM重写description，考虑forgetting curve（优先使用重写缓存）
+        """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = RewriteCache.make_key(REWRITE_MODEL, REWRITE_TEMPERATURE, description, concept,
+                                              mastery, delta_t_days, forgetting_score, forgetting_level)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                return cached
+        
+        try:
+            rewritten = self.request_rewrite(description, concept, mastery, delta_t_days,
+                                             forgetting_score, forgetting_level)
             if rewritten is None:
-                return description  # 如果失败，返回原始描述
+                return description  # 如果失败，返回原始描述（不写入缓存）
             
-            return rewritten.strip()
+            if cache_key is not None:
+                self.cache.put(cache_key, rewritten)
+            return rewritten
         
         except Exception as e:
+            reraise_cache_miss(e)  # replay模式下未录制的请求必须报错，而不是回退到原始描述
             print(f"⚠️ Rewrite失败: {e}")
             return description
     
+    @staticmethod
+    def parse_batch_response(content: str, num_items: int) -> List[str]:
+        """
+        解析批量重写返回的JSON数组
+        
+        支持 ["...", ...]、[{"index": 1, "description": "..."}, ...] 以及 {"descriptions": [...]}，
+        缺失或格式错误的条目返回None。
+        带index的条目按index对应；不带index的条目只有在数组长度恰好等于num_items时才按位置对应，
+        否则无法确定漏掉了哪一条，全部视为缺失（避免重写结果错位并写入缓存）
+        """
+        results = [None] * num_items
+        if not content:
+            return results
+        
+        # 去除可能的markdown代码块标记
+        content = content.strip()
+        if content.startswith("```json"):
+            content = content[7:]
+        if content.startswith("```"):
+            content = content[3:]
+        if content.endswith("```"):
+            content = content[:-3]
+        
+        try:
+            parsed = json.loads(content.strip())
+        except json.JSONDecodeError:
+            return results
+        
+        if isinstance(parsed, dict):
+            parsed = parsed.get('descriptions', [])
+        if not isinstance(parsed, list):
+            return results
+        
+        positional = len(parsed) == num_items
+        for position, entry in enumerate(parsed):
+            idx = position if positional else None
+            if isinstance(entry, dict):
+                if isinstance(entry.get('index'), int) and not isinstance(entry.get('index'), bool):
+                    idx = entry['index'] - 1
+                entry = entry.get('description')
+            if idx is not None and isinstance(entry, str) and entry.strip() and 0 <= idx < num_items:
+                results[idx] = entry.strip()
+        
+        return results
+    
+    def rewrite_descriptions_batched(self, descriptions: List[str], forgetting_info: Dict) -> List[str]:
+        """
+        批量模式：一轮的所有描述放进一个prompt，解析返回的JSON数组
+        
+        缓存命中的条目不再发送；缺失或格式错误的条目逐条回退到rewrite_description
+        """
+        info = {
+            'concept': forgetting_info['concept'],
+            'mastery': forgetting_info['mastery'],
+            'delta_t_days': forgetting_info['delta_t_days'],
+            'forgetting_score': forgetting_info['forgetting_score'],
+            'forgetting_level': forgetting_info['forgetting_level']
+        }
+        
+        results = [None] * len(descriptions)
+        cache_keys = [None] * len(descriptions)
+        if self.cache is not None:
+            for i, description in enumerate(descriptions):
+                cache_keys[i] = RewriteCache.make_key(REWRITE_MODEL, REWRITE_TEMPERATURE, description, **info)
+                results[i] = self.cache.get(cache_keys[i])
+        
+        pending = [i for i, text in enumerate(results) if text is None]
+        if pending:
+            system_message = """You are a personalized math tutor. Given a student's original states for a concept, including mastery, last practice interval, and forgetting score, rewrite each description to reflect time-dependent forgetting. Output only a JSON array of strings: one updated description per input, in the same order, each concise and specific to the concept."""
+            
+            numbered = "\n".join(f'{n}. "{descriptions[i]}"' for n, i in enumerate(pending, 1))
+            user_message = f"""The student's original states for concept "{info['concept']}", with mastery {info['mastery']:.2f}:
+{numbered}
+
+This concept was last practiced {info['delta_t_days']:.1f} days ago.
+
+Forgetting Score: {info['forgetting_score']:.4f} (range: 0-1, where higher values indicate more forgetting)
+Forgetting Level: {info['forgetting_level']} - {FORGETTING_LEVELS[info['forgetting_level']]}
+
+Rewrite each description to reflect the current knowledge state after forgetting. Return a JSON array with exactly {len(pending)} strings."""
+            
+            try:
+                content = self.complete([
+                    {"role": "system", "content": system_message},
+                    {"role": "user", "content": user_message}
+                ], max_tokens=300 * len(pending))
+                parsed = self.parse_batch_response(content, len(pending))
+            except Exception as e:
+                reraise_cache_miss(e)
+                print(f"⚠️ 批量Rewrite失败: {e}")
+                parsed = [None] * len(pending)
+            
+            for i, text in zip(pending, parsed):
+                if text is not None:
+                    results[i] = text
+                    if cache_keys[i] is not None:
+                        self.cache.put(cache_keys[i], text)
+        
+        # 缺失/格式错误的条目逐条回退（rewrite_description失败时返回原始描述）
+        missing = [i for i, text in enumerate(results) if text is None]
+        if missing:
+            print(f"   ⚠️  批量Rewrite缺少{len(missing)}条，逐条回退")
+            fallback = self.pool.map(lambda i: self.rewrite_description(description=descriptions[i], **info), missing)
+            for i, text in zip(missing, fallback):
+                results[i] = text
+        
+        return results
+    
     def rewrite_top_items(self, top_persona: List[Dict], top_memory: List[Dict],
-                         student_id: int, dataset: str, concept_text: str) -> Tuple[List[str], List[str]]:
+                         student_id: int, dataset: str, concept_text: str,
+                         forgetting_info: Optional[Dict] = None) -> Tuple[List[str], List[str]]:
         """
         重写top persona和memory的描述
         
+        Args:
+            forgetting_info: 已加载的forgetting信息（None时按student_id加载）
+        
         Returns:
             rewritten_persona: List of 3 rewritten persona descriptions
             rewritten_memory: List of 3 rewritten memory descriptions
         """
         # 加载forgetting信息
-        forgetting_info = self.load_forgetting_info(student_id, dataset, concept_text)
-        
-        # 重写persona
-        rewritten_persona = []
-        for item in top_persona:
-            rewritten = self.rewrite_description(
-                description=item['description'],
-                concept=forgetting_info['concept'],
-                mastery=forgetting_info['mastery'],
-                delta_t_days=forgetting_info['delta_t_days'],
-                forgetting_score=forgetting_info['forgetting_score'],
-                forgetting_level=forgetting_info['forgetting_level']
-            )
-            rewritten_persona.append(rewritten)
-        
-        # 重写memory
-        rewritten_memory = []
-        for item in top_memory:
-            rewritten = self.rewrite_description(
-                description=item['description'],
-                concept=forgetting_info['concept'],
-                mastery=forgetting_info['mastery'],
-                delta_t_days=forgetting_info['delta_t_days'],
-                forgetting_score=forgetting_info['forgetting_score'],
-                forgetting_level=forgetting_info['forgetting_level']
-            )
-            rewritten_memory.append(rewritten)
+        if forgetting_info is None:
+            forgetting_info = self.load_forgetting_info(student_id, dataset, concept_text)
+        
+        descriptions = [item['description'] for item in top_persona + top_memory]
+        rewritten = [None] * len(descriptions)
+        
+        # 优先使用离线预计算的结果，只有未命中的描述才在线调用LLM
+        store = self.get_precomputed_store(dataset)
+        if store is not None:
+            for i, description in enumerate(descriptions):
+                rewritten[i] = store.get(RewriteCache.make_key(
+                    REWRITE_MODEL, REWRITE_TEMPERATURE, description,
+                    concept=forgetting_info['concept'],
+                    mastery=forgetting_info['mastery'],
+                    delta_t_days=forgetting_info['delta_t_days'],
+                    forgetting_score=forgetting_info['forgetting_score'],
+                    forgetting_level=forgetting_info['forgetting_level']
+                ))
+        
+        pending = [i for i, text in enumerate(rewritten) if text is None]
+        pending_descriptions = [descriptions[i] for i in pending]
+        
+        if not pending:
+            online = []
+        elif REWRITE_MODE == "batched":
+            # 一次请求重写本轮所有描述
+            online = self.rewrite_descriptions_batched(pending_descriptions, forgetting_info)
+        else:
+            # persona和memory的重写并发发出，map保持顺序；单条失败时rewrite_description返回原始描述
+            online = list(self.pool.map(
+                lambda description: self.rewrite_description(
+                    description=description,
+                    concept=forgetting_info['concept'],
+                    mastery=forgetting_info['mastery'],
+                    delta_t_days=forgetting_info['delta_t_days'],
+                    forgetting_score=forgetting_info['forgetting_score'],
+                    forgetting_level=forgetting_info['forgetting_level']
+                ),
+                pending_descriptions
+            ))
+        
+        for i, text in zip(pending, online):
+            rewritten[i] = text
+        
+        rewritten_persona = rewritten[:len(top_persona)]
+        rewritten_memory = rewritten[len(top_persona):]
         
         return rewritten_persona, rewritten_memory
 
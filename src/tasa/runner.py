@@ -0,0 +1,254 @@
+"""
+TASA多会话Runner
+用asyncio并发执行大量 (student, concept) tutoring session，所有session共享一个TASATutor（即一个TASARAG和MasteryRewriter）
+
+- 每个session在线程池中运行（现有的LLM客户端都是同步的）
+- tutor / student / rewrite / grader 四个endpoint各自有独立的并发上限，超出的请求排队等待
+
+运行:
+    python runner.py --dataset assist2017 --num-students 1000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from typing import List, Dict, Optional
+
+from tasa_config import *
+from tasa_tutoring import TASATutor
+from tasa_forgetting import build_forgetting_index
+from llm_client_unified import (backend_stats, get_single_flight, get_response_cache, configure_response_cache,
+                                RESPONSE_CACHE_MODES)
+
+
+class EndpointLimiter:
+    """每个endpoint一个有界信号量，限制同时发出的请求数"""
+
+    def __init__(self, limits: Dict[str, int] = None):
+        limits = limits or {
+            'tutor': TUTOR_MAX_CONCURRENCY,
+            'student': STUDENT_MAX_CONCURRENCY,
+            'rewrite': REWRITE_MAX_CONCURRENCY,
+            'grader': GRADER_MAX_CONCURRENCY,
+        }
+        self.limits = dict(limits)
+        self.semaphores = {endpoint: threading.BoundedSemaphore(limit) for endpoint, limit in limits.items()}
+        self.calls = {endpoint: 0 for endpoint in limits}
+        self._lock = threading.Lock()
+
+    def wrap(self, endpoint: str, fn):
+        """返回受endpoint并发上限约束的fn"""
+        semaphore = self.semaphores[endpoint]
+
+        def limited(*args, **kwargs):
+            with semaphore:
+                with self._lock:
+                    self.calls[endpoint] += 1
+                return fn(*args, **kwargs)
+
+        return limited
+
+    def wrap_openai(self, endpoint: str, client):
+        """包装OpenAI客户端，只暴露chat.completions.create（受endpoint并发上限约束）"""
+        create = self.wrap(endpoint, client.chat.completions.create)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+class TutoringRunner:
+    def __init__(self, tutor: TASATutor = None, evaluator=None,
+                 max_sessions: int = SESSION_MAX_CONCURRENCY,
+                 limiter: EndpointLimiter = None, backbone_suffix: str = ''):
+        """
+        Args:
+            tutor: 共享的TASATutor（默认新建一个）
+            evaluator: 可选的TASAEvaluator，提供时每个session结束后进行post-test评估
+            max_sessions: 同时进行的session数
+            backbone_suffix: 对话保存目录的backbone后缀
+        """
+        self.tutor = tutor or TASATutor()
+        self.evaluator = evaluator
+        self.max_sessions = max_sessions
+        self.limiter = limiter or EndpointLimiter()
+        self.backbone_suffix = backbone_suffix
+
+        # 所有LLM调用都经过对应endpoint的并发限制
+        self.tutor.tutor_client.chat_completion = self.limiter.wrap('tutor', self.tutor.tutor_client.chat_completion)
+        self.tutor.openai_client = self.limiter.wrap_openai('student', self.tutor.openai_client)
+        self.tutor.rewriter.client = self.limiter.wrap_openai('rewrite', self.tutor.rewriter.client)
+        # 重写线程池由所有session共享：扩大到rewrite endpoint的上限，只由endpoint信号量限制并发
+        self.tutor.rewriter.set_max_workers(self.limiter.limits['rewrite'])
+        if self.evaluator is not None:
+            self.evaluator.client = self.limiter.wrap_openai('student', self.evaluator.client)
+            self.evaluator.grade_answers = self.limiter.wrap('grader', self.evaluator.grade_answers)
+
+        # 各session同一轮的检索合并成批（一次encode + 一个reranker batch）
+        if RAG_CROSS_SESSION_BATCHING:
+            self.tutor.rag.enable_batching()
+
+        self.pool = ThreadPoolExecutor(max_workers=max_sessions, thread_name_prefix='tasa-session')
+
+    def run_session_sync(self, spec: Dict) -> Dict:
+        """执行一个session：tutoring -> 保存对话 -> （可选）评估"""
+        start = time.time()
+        checkpoint_file = None
+        if CHECKPOINT_ROUNDS:
+            checkpoint_file = self.tutor.checkpoint_path(
+                spec['student_id'], spec['concept_text'], spec['dataset'], self.backbone_suffix)
+        dialogue = self.tutor.conduct_tutoring_session(
+            student_id=spec['student_id'],
+            dataset=spec['dataset'],
+            concept_text=spec['concept_text'],
+            student_system_prompt=spec['student_system_prompt'],
+            checkpoint_file=checkpoint_file
+        )
+        dialogue_file = self.tutor.save_dialogue(
+            dialogue, spec['student_id'], spec['concept_text'], spec['dataset'], self.backbone_suffix)
+
+        result = {
+            'student_id': spec['student_id'],
+            'concept_text': spec['concept_text'],
+            'dialogue_file': dialogue_file,
+        }
+
+        if self.evaluator is not None and spec.get('questions'):
+            evaluation = self.evaluator.evaluate_single_student(
+                student_id=spec['student_id'],
+                dataset=spec['dataset'],
+                concept_text=spec['concept_text'],
+                concept_id=spec['concept_id'],
+                questions=spec['questions'],
+                student_system_prompt=spec['student_system_prompt']
+            )
+            if evaluation is not None:
+                result['evaluation_file'] = self.evaluator.save_evaluation_result(evaluation, method="TASA")
+                result['learning_gain'] = evaluation['learning_gain']
+
+        result['seconds'] = time.time() - start
+        return result
+
+    async def run_session(self, spec: Dict, semaphore: asyncio.Semaphore) -> Dict:
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(self.pool, self.run_session_sync, spec)
+            except Exception as e:
+                # 单个session失败不影响其他session
+                print(f"❌ 学生 {spec['student_id']} ({spec['concept_text']}) session失败: {e}")
+                return {'student_id': spec['student_id'], 'concept_text': spec['concept_text'], 'error': repr(e)}
+
+    async def run_all(self, specs: List[Dict]) -> List[Dict]:
+        semaphore = asyncio.Semaphore(self.max_sessions)
+        return await asyncio.gather(*(self.run_session(spec, semaphore) for spec in specs))
+
+    def pending_specs(self, specs: List[Dict]) -> List[Dict]:
+        """跳过 DIALOGUE_DIR/{backbone}/{dataset}/{method} 下已经存在对话的session"""
+        pending = [spec for spec in specs if not os.path.exists(self.tutor.dialogue_path(
+            spec['student_id'], spec['concept_text'], spec['dataset'], self.backbone_suffix))]
+        if len(pending) < len(specs):
+            print(f"⏭️  跳过 {len(specs) - len(pending)} 个已完成的session")
+        return pending
+
+    def run(self, specs: List[Dict], skip_existing: bool = True) -> List[Dict]:
+        """并发执行所有session，返回与specs顺序一致的结果"""
+        if skip_existing:
+            specs = self.pending_specs(specs)
+        start = time.time()
+        results = asyncio.run(self.run_all(specs))
+        elapsed = time.time() - start
+
+        num_failed = sum('error' in result for result in results)
+        print(f"\n✅ 完成 {len(results) - num_failed}/{len(results)} 个session，用时 {elapsed:.1f}s")
+        print(f"   Endpoint调用次数: {self.limiter.calls}")
+        print(f"   RAG缓存: bank={self.tutor.rag.bank_cache.stats()}, query={self.tutor.rag.query_cache.stats()}, "
+              f"rerank={self.tutor.rag.rerank_cache.stats()}")
+        if self.tutor.rag.batcher is not None:
+            print(f"   检索批处理: {self.tutor.rag.batcher.stats()}")
+        print(f"   请求合并: {get_single_flight().stats()}")
+        for backend, stats in backend_stats().items():
+            print(f"   {backend} 限流/重试: {stats}")
+        if get_response_cache() is not None:
+            print(f"   LLM响应缓存: {get_response_cache().stats()}")
+        return results
+
+
+def backbone_suffix_for(tutor_model: str = TUTOR_MODEL) -> str:
+    """根据TUTOR_MODEL决定对话目录的backbone后缀"""
+    if 'llama' in tutor_model.lower():
+        return '-llama'
+    elif 'qwen' in tutor_model.lower():
+        return '-qwen'
+    return ''  # gpt-oss-120b
+
+
+def load_session_specs(dataset: str, num_students: Optional[int] = None,
+                       questions_file: Optional[str] = None) -> List[Dict]:
+    """从SESSION_DIR构建所有session的参数（按student_id排序）"""
+    from student_roleplay_evaluation import build_student_system_prompt, load_session
+
+    session_dir = f"{SESSION_DIR}/{dataset}"
+    student_ids = sorted(int(os.path.splitext(f)[0]) for f in os.listdir(session_dir)
+                         if f.endswith('.json') and os.path.splitext(f)[0].isdigit())
+    if num_students is not None:
+        student_ids = student_ids[:num_students]
+
+    all_questions = {}
+    if questions_file:
+        with open(questions_file) as f:
+            all_questions = json.load(f)
+
+    specs = []
+    for student_id in student_ids:
+        session = load_session(f"{session_dir}/{student_id}.json")
+        concept_id = str(session.get('concept_id'))
+        specs.append({
+            'student_id': student_id,
+            'dataset': dataset,
+            'concept_text': session['concept_text'],
+            'concept_id': concept_id,
+            'student_system_prompt': build_student_system_prompt(session),
+            'questions': all_questions.get(concept_id, {}).get('questions'),
+        })
+    return specs
+
+
+def main():
+    parser = argparse.ArgumentParser(description='并发运行TASA tutoring session')
+    parser.add_argument('--dataset', type=str, required=True, help='数据集名称')
+    parser.add_argument('--num-students', type=int, default=None, help='只运行前N个学生（默认全部）')
+    parser.add_argument('--max-sessions', type=int, default=SESSION_MAX_CONCURRENCY, help='同时进行的session数')
+    parser.add_argument('--evaluate', action='store_true', help='每个session结束后进行post-test评估')
+    parser.add_argument('--no-skip-existing', action='store_true', help='不跳过已经存在对话的session（重新生成）')
+    parser.add_argument('--llm-cache', type=str, default=None, choices=RESPONSE_CACHE_MODES,
+                        help='LLM响应缓存模式（默认读取环境变量LLM_CACHE_MODE）；replay只读缓存，可离线重跑')
+    parser.add_argument('--questions-file', type=str, default=None,
+                        help='测试题目文件（默认 bank/test_data/{dataset}/concept_questions.json）')
+    args = parser.parse_args()
+
+    if args.llm_cache is not None:
+        configure_response_cache(args.llm_cache)
+
+    evaluator = None
+    questions_file = None
+    if args.evaluate:
+        from evaluate_tasa import TASAEvaluator
+        evaluator = TASAEvaluator()
+        questions_file = args.questions_file or f"/mnt/localssd/bank/test_data/{args.dataset}/concept_questions.json"
+
+    # 启动时（增量）构建forgetting索引；运行期间只读取，不再重建
+    build_forgetting_index(args.dataset)
+
+    specs = load_session_specs(args.dataset, args.num_students, questions_file)
+    print(f"🎓 {args.dataset}: {len(specs)} 个session，并发 {args.max_sessions}")
+
+    runner = TutoringRunner(evaluator=evaluator, max_sessions=args.max_sessions,
+                            backbone_suffix=backbone_suffix_for())
+    runner.run(specs, skip_existing=not args.no_skip_existing)
+
+
+if __name__ == "__main__":
+    main()
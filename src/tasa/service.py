@@ -0,0 +1,374 @@
+"""
+TASA交互式Tutoring服务
+基于aiohttp的异步HTTP服务，把tutoring拆成逐轮调用:
+
+    POST   /sessions                        开始session {student_id, dataset, concept_text}
+    POST   /sessions/{session_id}/student   学生发言 {content}（第一轮可省略，默认 "I want to learn about {concept}"）
+    POST   /sessions/{session_id}/tutor     生成tutor回复（针对最后一条学生发言）
+                                            ?stream=1 时以SSE逐段返回（event: token），最后发送完整消息（event: done），
+                                            生成失败时发送 event: error 并结束
+    GET    /sessions/{session_id}           查看session状态
+    DELETE /sessions/{session_id}           结束session
+    GET    /metrics                         每个endpoint的延迟统计
+
+- 学生发言后立即在后台预取该轮的RAG检索+重写，tutor请求到达时直接使用
+- session状态（对话、缓存的检索结果、forgetting信息）保存在可插拔的SessionStore中
+- 空闲超过SERVICE_SESSION_IDLE_TTL_S的session定期清除
+
+运行:
+    python service.py
+"""
+
+import asyncio
+import functools
+import json
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+import numpy as np
+from aiohttp import web
+
+from tasa_config import *
+from tasa_tutoring import TASATutor
+from tasa_session_store import SessionStore, create_session_store
+
+
+class LatencyMetrics:
+    """每个endpoint最近window次请求的延迟统计"""
+
+    def __init__(self, window: int = SERVICE_METRICS_WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = {}
+        self.errors = {}
+
+    def record(self, endpoint: str, seconds: float, error: bool = False):
+        self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds * 1000)
+        self.counts[endpoint] = self.counts.get(endpoint, 0) + 1
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + int(error)
+
+    def summary(self) -> Dict:
+        summary = {}
+        for endpoint, latencies in self.latencies.items():
+            values = np.asarray(latencies)
+            summary[endpoint] = {
+                'count': self.counts[endpoint],
+                'errors': self.errors[endpoint],
+                'mean_ms': float(values.mean()),
+                'p50_ms': float(np.percentile(values, 50)),
+                'p95_ms': float(np.percentile(values, 95)),
+                'max_ms': float(values.max()),
+            }
+        return summary
+
+
+def json_error(status: int, message: str) -> web.Response:
+    return web.json_response({'error': message}, status=status)
+
+
+def sse_event(event: str, data: Dict) -> bytes:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+
+
+class TutoringService:
+    def __init__(self, tutor: TASATutor = None, store: SessionStore = None,
+                 max_workers: int = SERVICE_MAX_WORKERS,
+                 idle_ttl: float = SERVICE_SESSION_IDLE_TTL_S,
+                 evict_interval: float = SERVICE_EVICT_INTERVAL_S):
+        """初始化服务（所有session共享一个TASATutor）"""
+        self.tutor = tutor or TASATutor()
+        # 所有session共享一个重写线程池，按rewrite endpoint的并发上限设置
+        self.tutor.rewriter.set_max_workers(REWRITE_MAX_CONCURRENCY)
+        self.store = store or create_session_store()
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tasa-service')
+        self.metrics = LatencyMetrics()
+        self.idle_ttl = idle_ttl
+        self.evict_interval = evict_interval
+
+        # 同一个session的请求串行处理；学生发言后的检索预取任务
+        self._locks = {}
+        self._prefetch = {}
+
+    async def _run(self, fn, *args, **kwargs):
+        """在线程池中执行阻塞调用（RAG、LLM）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.pool, functools.partial(fn, *args, **kwargs))
+
+    async def _locked_state(self, session_id: str):
+        """
+        获取session的锁并读取状态；session不存在时返回 (None, None)，不为未知的session_id创建锁
+
+        Returns:
+            (lock, state)：lock已被获取，调用方负责释放
+        """
+        lock = self._locks.get(session_id)
+        if lock is None:
+            if await self._run(self.store.get, session_id) is None:
+                return None, None
+            lock = self._locks.setdefault(session_id, asyncio.Lock())
+
+        await lock.acquire()
+        state = await self._run(self.store.get, session_id)
+        if state is None:
+            # 等待期间session被删除或清除
+            lock.release()
+            self._forget(session_id)
+            return None, None
+        return lock, state
+
+    def _forget(self, session_id: str):
+        self._locks.pop(session_id, None)
+        task = self._prefetch.pop(session_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def _retrieve(self, state: Dict, query: str, round_num: int) -> Dict:
+        retrieval = await self._run(self.tutor.retrieve_for_turn, query, state['student_id'], state['dataset'],
+                                    state['concept_text'], forgetting_info=state['forgetting_info'])
+        return {'round': round_num, **retrieval}
+
+    # ---------------- handlers ----------------
+
+    async def start_session(self, request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+            student_id, dataset, concept_text = int(body['student_id']), body['dataset'], body['concept_text']
+        except (ValueError, KeyError, TypeError):
+            return json_error(400, "student_id, dataset and concept_text are required")
+
+        try:
+            forgetting_info = await self._run(self.tutor.rewriter.load_forgetting_info,
+                                              student_id, dataset, concept_text)
+        except FileNotFoundError:
+            return json_error(404, f"No session data for student {student_id} in {dataset}")
+
+        state = {
+            'session_id': uuid.uuid4().hex,
+            'student_id': student_id,
+            'dataset': dataset,
+            'concept_text': concept_text,
+            'forgetting_info': forgetting_info,
+            'dialogue': [],
+            'retrieval': None,  # 最近一次学生发言对应的检索+重写结果
+            'created_at': time.time(),
+        }
+        await self._run(self.store.put, state)
+        return web.json_response({'session_id': state['session_id'], 'forgetting_info': forgetting_info}, status=201)
+
+    async def student_turn(self, request: web.Request) -> web.Response:
+        session_id = request.match_info['session_id']
+        try:
+            body = await request.json() if request.can_read_body else {}
+        except ValueError:
+            return json_error(400, "Invalid JSON body")
+
+        lock, state = await self._locked_state(session_id)
+        if state is None:
+            return json_error(404, f"Unknown session: {session_id}")
+
+        try:
+            dialogue = state['dialogue']
+            if dialogue and dialogue[-1]['role'] == 'user':
+                return json_error(409, "Waiting for tutor reply")
+
+            content = (body.get('content') or '').strip()
+            if not content:
+                if dialogue:
+                    return json_error(400, "content is required")
+                content = f"I want to learn about {state['concept_text']}"
+
+            round_num = dialogue[-1]['round'] + 1 if dialogue else 0
+            dialogue.append({"role": "user", "round": round_num, "content": content})
+            state['retrieval'] = None
+            await self._run(self.store.put, state)
+
+            # 后台预取本轮的检索+重写
+            self._prefetch[session_id] = asyncio.ensure_future(self._retrieve(state, content, round_num))
+        finally:
+            lock.release()
+
+        return web.json_response({'session_id': session_id, 'round': round_num})
+
+    async def _turn_retrieval(self, session_id: str, state: Dict, last: Dict) -> Dict:
+        """本轮的检索结果：已缓存 -> 预取任务 -> 重新计算（结果写回session状态）"""
+        retrieval = state.get('retrieval')
+        if retrieval is not None and retrieval['round'] == last['round']:
+            return retrieval
+
+        retrieval = None
+        task = self._prefetch.pop(session_id, None)
+        if task is not None:
+            try:
+                retrieval = await task
+            except Exception as e:
+                print(f"⚠️ 检索预取失败，重新计算: {e}")
+        if retrieval is None or retrieval['round'] != last['round']:
+            retrieval = await self._retrieve(state, last['content'], last['round'])
+
+        state['retrieval'] = retrieval
+        await self._run(self.store.put, state)
+        return retrieval
+
+    async def _stream_reply(self, request: web.Request, state: Dict, retrieval: Dict):
+        """在线程池中流式生成tutor回复，边生成边以SSE发送；客户端断开时继续生成，保证对话记录完整"""
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+
+        loop = asyncio.get_running_loop()
+        tokens = asyncio.Queue()
+        future = loop.run_in_executor(self.pool, functools.partial(
+            self.tutor.tutor_reply, state['dialogue'], state['concept_text'], retrieval,
+            on_token=lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token)))
+        future.add_done_callback(lambda _: tokens.put_nowait(None))
+
+        start = time.perf_counter()
+        connected = True
+        first = True
+        while True:
+            token = await tokens.get()
+            if token is None:
+                break
+            if first:
+                self.metrics.record('tutor_turn_ttft', time.perf_counter() - start)
+                first = False
+            if connected:
+                try:
+                    await response.write(sse_event('token', {'token': token}))
+                except ConnectionResetError:
+                    connected = False
+
+        try:
+            content = await future
+        except Exception as e:
+            # 响应头已经发出：以error事件结束流，让客户端能区分失败和连接中断（学生发言保留，可重试）
+            print(f"⚠️ 流式生成tutor回复失败: {e}")
+            response['error'] = True
+            if connected:
+                try:
+                    await response.write(sse_event('error', {'error': str(e)}))
+                    await response.write_eof()
+                except ConnectionResetError:
+                    pass
+            return response, None, False
+
+        return response, content, connected
+
+    async def tutor_turn(self, request: web.Request) -> web.StreamResponse:
+        session_id = request.match_info['session_id']
+        stream = request.query.get('stream', '').lower() in ('1', 'true')
+
+        lock, state = await self._locked_state(session_id)
+        if state is None:
+            return json_error(404, f"Unknown session: {session_id}")
+
+        try:
+            dialogue = state['dialogue']
+            if not dialogue or dialogue[-1]['role'] != 'user':
+                return json_error(409, "Waiting for student turn")
+            last = dialogue[-1]
+
+            retrieval = await self._turn_retrieval(session_id, state, last)
+
+            if stream:
+                response, content, connected = await self._stream_reply(request, state, retrieval)
+                if content is None:
+                    return response
+            else:
+                content = await self._run(self.tutor.tutor_reply, dialogue, state['concept_text'], retrieval)
+
+            message = {
+                "role": "assistant",
+                "round": max(1, last['round']),
+                "content": content,
+                **{key: value for key, value in retrieval.items() if key != 'round'}
+            }
+            dialogue.append(message)
+            await self._run(self.store.put, state)
+        finally:
+            lock.release()
+
+        if not stream:
+            return web.json_response({'session_id': session_id, **message})
+
+        if connected:
+            try:
+                await response.write(sse_event('done', {'session_id': session_id, **message}))
+                await response.write_eof()
+            except ConnectionResetError:
+                pass
+        return response
+
+    async def get_session(self, request: web.Request) -> web.Response:
+        session_id = request.match_info['session_id']
+        state = await self._run(self.store.get, session_id)
+        if state is None:
+            return json_error(404, f"Unknown session: {session_id}")
+        return web.json_response(state)
+
+    async def delete_session(self, request: web.Request) -> web.Response:
+        session_id = request.match_info['session_id']
+        deleted = await self._run(self.store.delete, session_id)
+        self._forget(session_id)
+        if not deleted:
+            return json_error(404, f"Unknown session: {session_id}")
+        return web.json_response({'session_id': session_id, 'deleted': True})
+
+    async def get_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            'endpoints': self.metrics.summary(),
+            'active_sessions': await self._run(len, self.store),
+        })
+
+    # ---------------- app ----------------
+
+    @web.middleware
+    async def metrics_middleware(self, request: web.Request, handler):
+        start = time.perf_counter()
+        endpoint = request.match_info.route.name or request.path
+        try:
+            response = await handler(request)
+        except Exception:
+            self.metrics.record(endpoint, time.perf_counter() - start, error=True)
+            raise
+        self.metrics.record(endpoint, time.perf_counter() - start,
+                            error=response.status >= 500 or response.get('error', False))
+        return response
+
+    async def evict_idle_sessions(self):
+        """定期清除空闲session"""
+        while True:
+            await asyncio.sleep(self.evict_interval)
+            evicted = await self._run(self.store.evict_idle, self.idle_ttl)
+            for session_id in evicted:
+                self._forget(session_id)
+            if evicted:
+                print(f"🧹 清除 {len(evicted)} 个空闲session")
+
+    async def _start_background(self, app: web.Application):
+        app['evict_task'] = asyncio.ensure_future(self.evict_idle_sessions())
+
+    async def _stop_background(self, app: web.Application):
+        app['evict_task'].cancel()
+        self.pool.shutdown(wait=False)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.metrics_middleware])
+        app.add_routes([
+            web.post('/sessions', self.start_session, name='start_session'),
+            web.post('/sessions/{session_id}/student', self.student_turn, name='student_turn'),
+            web.post('/sessions/{session_id}/tutor', self.tutor_turn, name='tutor_turn'),
+            web.get('/sessions/{session_id}', self.get_session, name='get_session'),
+            web.delete('/sessions/{session_id}', self.delete_session, name='delete_session'),
+            web.get('/metrics', self.get_metrics, name='metrics'),
+        ])
+        app.on_startup.append(self._start_background)
+        app.on_cleanup.append(self._stop_background)
+        return app
+
+
+if __name__ == "__main__":
+    service = TutoringService()
+    web.run_app(service.make_app(), host=SERVICE_HOST, port=SERVICE_PORT)
@@ -0,0 +1,123 @@
+"""
+TASA会话状态存储
+交互式tutoring服务的session状态（对话、缓存的检索结果、forgetting信息），可插拔:
+- InMemorySessionStore: 进程内dict
+- SQLiteSessionStore: SQLite持久化，服务重启后session仍可继续
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Dict, Optional
+
+from tasa_config import *
+
+
+class SessionStore:
+    """session状态存储接口：状态是可JSON序列化的dict，必须包含session_id"""
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        raise NotImplementedError
+
+    def put(self, state: Dict):
+        """写入状态并刷新最后活跃时间"""
+        raise NotImplementedError
+
+    def delete(self, session_id: str) -> bool:
+        raise NotImplementedError
+
+    def evict_idle(self, max_idle_seconds: float) -> List[str]:
+        """删除超过max_idle_seconds未活跃的session，返回被删除的session_id"""
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+
+class InMemorySessionStore(SessionStore):
+    def __init__(self):
+        self._states = {}
+        self._last_active = {}
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            state = self._states.get(session_id)
+            return json.loads(json.dumps(state)) if state is not None else None  # 返回副本
+
+    def put(self, state: Dict):
+        with self._lock:
+            self._states[state['session_id']] = json.loads(json.dumps(state))
+            self._last_active[state['session_id']] = time.time()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            self._last_active.pop(session_id, None)
+            return self._states.pop(session_id, None) is not None
+
+    def evict_idle(self, max_idle_seconds: float) -> List[str]:
+        cutoff = time.time() - max_idle_seconds
+        with self._lock:
+            evicted = [session_id for session_id, last_active in self._last_active.items() if last_active < cutoff]
+            for session_id in evicted:
+                del self._states[session_id]
+                del self._last_active[session_id]
+        return evicted
+
+    def __len__(self):
+        return len(self._states)
+
+
+class SQLiteSessionStore(SessionStore):
+    def __init__(self, path: str = SERVICE_SESSION_DB):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                               '(session_id TEXT PRIMARY KEY, state TEXT, last_active REAL)')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions (last_active)')
+            self._conn.commit()
+
+    def get(self, session_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute('SELECT state FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, state: Dict):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO sessions (session_id, state, last_active) VALUES (?, ?, ?)',
+                               (state['session_id'], json.dumps(state), time.time()))
+            self._conn.commit()
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            cursor = self._conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def evict_idle(self, max_idle_seconds: float) -> List[str]:
+        cutoff = time.time() - max_idle_seconds
+        with self._lock:
+            evicted = [row[0] for row in self._conn.execute(
+                'SELECT session_id FROM sessions WHERE last_active < ?', (cutoff,))]
+            self._conn.execute('DELETE FROM sessions WHERE last_active < ?', (cutoff,))
+            self._conn.commit()
+        return evicted
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+def create_session_store(kind: str = SERVICE_SESSION_STORE) -> SessionStore:
+    """根据配置创建session存储: "memory" / "sqlite" """
+    if kind == "memory":
+        return InMemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore()
+    raise ValueError(f"Unknown session store: {kind}")
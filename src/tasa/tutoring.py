@@ -5,14 +5,14 @@ TASA Tutoring核心模块
 
 import json
 import os
-from typing import List, Dict, Tuple
-from openai import OpenAI
+from typing import List, Dict, Tuple, Optional, Callable
 from tqdm import tqdm
 
 from tasa_config import *
 from tasa_rag import TASARAG
 from tasa_rewrite import MasteryRewriter
-from llm_client_unified import UnifiedLLMClient
+from llm_client_unified import (UnifiedLLMClient, LLMRequestError, ResponseCacheMiss, get_openai_client,
+                                raise_for_llm_error)
 
 class TASATutor:
     def __init__(self):
@@ -22,11 +22,8 @@ class TASATutor:
         # 初始化统一LLM客户端（用于TUTOR_MODEL）
         self.tutor_client = UnifiedLLMClient(TUTOR_MODEL)
         
-        # 初始化OpenAI客户端（用于其他模型：STUDENT_MODEL, GRADER_MODEL等）
-        self.openai_client = OpenAI(
-            api_key=API_KEY,
-            base_url=ENDPOINT
-        )
+        # 初始化OpenAI客户端（用于其他模型：STUDENT_MODEL, GRADER_MODEL等；进程内共享连接池）
+        self.openai_client = get_openai_client(API_KEY, ENDPOINT)
         
         # 初始化RAG和重写模块
         self.rag = TASARAG()
@@ -34,11 +31,38 @@ class TASATutor:
         
         print("✅ TASA Tutor初始化完成")
     
+    def tutor_completion(self, messages: List[Dict], on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        调用TUTOR_MODEL；提供on_token时使用流式输出，每收到一段文本回调一次，返回拼接后的完整回复
+        （非流式调用按TUTOR_SINGLE_FLIGHT合并同时在途的相同请求）
+        """
+        if on_token is None:
+            return self.tutor_client.chat_completion(
+                messages=messages,
+                temperature=TUTOR_TEMPERATURE,
+                max_tokens=MAX_TOKENS_TUTOR,
+                coalesce=TUTOR_SINGLE_FLIGHT
+            )
+        
+        parts = []
+        for token in self.tutor_client.chat_completion_stream(
+            messages=messages,
+            temperature=TUTOR_TEMPERATURE,
+            max_tokens=MAX_TOKENS_TUTOR
+        ):
+            parts.append(token)
+            on_token(token)
+        return "".join(parts)
+    
     def generate_first_question(self, rewritten_persona: List[str], 
                                rewritten_memory: List[str],
-                               concept_text: str) -> str:
+                               concept_text: str,
+                               on_token: Optional[Callable[[str], None]] = None) -> str:
         """
         生成第一个问题（学生表达想学习某个concept后）
+        
+        Args:
+            on_token: 可选的流式回调（每段生成的文本调用一次）
         """
         system_message = """You are a personalized math tutor. Generate the first practice question for a student who wants to learn a specific concept. The question should be calibrated to the student's current knowledge state."""
         
@@ -55,17 +79,18 @@ The student wants to learn about: {concept_text}
 Generate an appropriate first practice question for this concept, tailored to the student's current knowledge level. The question should help assess and build their understanding."""
         
         try:
-            content = self.tutor_client.chat_completion(
+            content = self.tutor_completion(
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": user_message}
                 ],
-                temperature=TUTOR_TEMPERATURE,
-                max_tokens=MAX_TOKENS_TUTOR
+                on_token=on_token
             )
             
             return content.strip() if content else "Let's start with a basic question about this concept."
         
+        except (LLMRequestError, ResponseCacheMiss):
+            raise  # 重试用尽/replay未命中：让session失败（可从checkpoint恢复），而不是保存占位回复
         except Exception as e:
             print(f"⚠️ 生成第一个问题失败: {e}")
             return "Let's begin. Can you explain what you know about this concept?"
@@ -73,12 +98,14 @@ Generate an appropriate first practice question for this concept, tailored to th
     def generate_explanation_and_question(self, rewritten_persona: List[str],
                                          rewritten_memory: List[str],
                                          conversation_history: List[Dict],
-                                         concept_text: str) -> str:
+                                         concept_text: str,
+                                         on_token: Optional[Callable[[str], None]] = None) -> str:
         """
         生成讲解+下一个问题（第2-10轮）
         
         Args:
             conversation_history: List of {"role": "user/assistant", "content": "..."}
+            on_token: 可选的流式回调（每段生成的文本调用一次）
         """
         system_message = """You are a personalized math tutor. Generate the next instructional content that first explains the student's most recent response and then provides the next practice question, calibrated to the current retention state."""
         
@@ -105,17 +132,18 @@ Produce a response that includes:
 Keep your response clear, encouraging, and pedagogically sound."""
         
         try:
-            content = self.tutor_client.chat_completion(
+            content = self.tutor_completion(
                 messages=[
                     {"role": "system", "content": system_message},
                     {"role": "user", "content": user_message}
                 ],
-                temperature=TUTOR_TEMPERATURE,
-                max_tokens=MAX_TOKENS_TUTOR
+                on_token=on_token
             )
             
             return content.strip() if content else "Let's continue with the next question."
         
+        except (LLMRequestError, ResponseCacheMiss):
+            raise  # 重试用尽/replay未命中：让session失败（可从checkpoint恢复），而不是保存占位回复
         except Exception as e:
             print(f"⚠️ 生成讲解+问题失败: {e}")
             return "Let's move on to the next question."
@@ -143,43 +171,20 @@ Keep your response clear, encouraging, and pedagogically sound."""
             return content.strip() if content else "I'm not sure how to answer this."
         
         except Exception as e:
+            raise_for_llm_error(e, 'Student')
             print(f"⚠️ 获取学生回答失败: {e}")
             return "I'm not sure."
     
-    def conduct_tutoring_session(self, student_id: int, dataset: str, 
-                                 concept_text: str,
-                                 student_system_prompt: str) -> List[Dict]:
+    def retrieve_for_turn(self, query: str, student_id: int, dataset: str, concept_text: str,
+                          forgetting_info: Optional[Dict] = None) -> Dict:
         """
-        进行完整的tutoring session（10轮）
-        
-        Args:
-            student_id: 学生ID
-            dataset: 数据集名称
-            concept_text: 学习的concept
-            student_system_prompt: 学生role-play的system prompt
+        一轮的RAG检索 + forgetting重写
         
         Returns:
-            dialogue: List of {"role": "user/assistant", "round": int, "content": str}
+            {"retrieved_persona", "retrieved_memory", "rewritten_persona", "rewritten_memory"}（均为描述文本列表）
         """
-        print(f"\n🎓 开始Tutoring Session")
-        print(f"   学生ID: {student_id}")
-        print(f"   Concept: {concept_text}")
-        print(f"   轮数: {NUM_TUTORING_ROUNDS}")
-        
-        dialogue = []
-        
-        # 第一轮：学生表达想学习
-        initial_query = f"I want to learn about {concept_text}"
-        dialogue.append({
-            "role": "user",
-            "round": 0,
-            "content": initial_query
-        })
-        
-        # RAG检索并重写
-        print(f"\n📚 Round 1: 生成初始问题")
         top_persona, top_memory = self.rag.retrieve_and_rerank(
-            query=initial_query,
+            query=query,
             student_id=student_id,
             dataset=dataset,
             concept_text=concept_text
@@ -189,28 +194,134 @@ Keep your response clear, encouraging, and pedagogically sound."""
             top_persona, top_memory,
             student_id=student_id,
             dataset=dataset,
-            concept_text=concept_text
+            concept_text=concept_text,
+            forgetting_info=forgetting_info
         )
         
-        # 生成第一个问题
-        first_question = self.generate_first_question(
-            rewritten_persona, rewritten_memory, concept_text
-        )
-        
-        dialogue.append({
-            "role": "assistant",
-            "round": 1,
-            "content": first_question,
+        return {
             "retrieved_persona": [p['description'] for p in top_persona],
             "retrieved_memory": [m['description'] for m in top_memory],
             "rewritten_persona": rewritten_persona,
             "rewritten_memory": rewritten_memory
-        })
+        }
+    
+    def tutor_reply(self, dialogue: List[Dict], concept_text: str, retrieval: Dict,
+                    on_token: Optional[Callable[[str], None]] = None) -> str:
+        """
+        根据已有对话生成tutor回复：只有学生的初始请求时生成第一个问题，否则生成讲解+下一个问题
+        """
+        if len(dialogue) <= 1:
+            return self.generate_first_question(
+                retrieval['rewritten_persona'], retrieval['rewritten_memory'], concept_text,
+                on_token=on_token
+            )
         
-        print(f"   ✅ 问题已生成")
+        conversation_history = [{"role": msg["role"], "content": msg["content"]} for msg in dialogue]
+        return self.generate_explanation_and_question(
+            retrieval['rewritten_persona'], retrieval['rewritten_memory'],
+            conversation_history, concept_text, on_token=on_token
+        )
+    
+    def load_checkpoint(self, checkpoint_file: str) -> List[Dict]:
+        """
+        读取per-round checkpoint（JSONL，每行一轮: {"round": int, "messages": [...]}）
+        
+        Returns:
+            已完成轮次的dialogue（崩溃时写了一半的最后一行会被忽略）
+        """
+        dialogue = []
+        if not os.path.exists(checkpoint_file):
+            return dialogue
+        
+        expected_round = 1
+        valid_bytes = 0
+        with open(checkpoint_file, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                if not line.endswith(b"\n") or record.get('round') != expected_round:
+                    break
+                dialogue.extend(record['messages'])
+                expected_round += 1
+                valid_bytes += len(line)
+        
+        # 截掉无效的尾部，保证之后追加的轮次紧跟在最后一个完整记录后面
+        if valid_bytes < os.path.getsize(checkpoint_file):
+            with open(checkpoint_file, 'r+b') as f:
+                f.truncate(valid_bytes)
+        return dialogue
+    
+    def append_checkpoint(self, checkpoint_file: str, round_num: int, messages: List[Dict]):
+        """追加一轮到checkpoint并落盘"""
+        with open(checkpoint_file, 'a') as f:
+            f.write(json.dumps({"round": round_num, "messages": messages}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def conduct_tutoring_session(self, student_id: int, dataset: str, 
+                                 concept_text: str,
+                                 student_system_prompt: str,
+                                 checkpoint_file: Optional[str] = None) -> List[Dict]:
+        """
+        进行完整的tutoring session（10轮）
+        
+        Args:
+            student_id: 学生ID
+            dataset: 数据集名称
+            concept_text: 学习的concept
+            student_system_prompt: 学生role-play的system prompt
+            checkpoint_file: 可选的per-round checkpoint路径，每轮结束后追加；已存在时从最后完成的一轮继续
+        
+        Returns:
+            dialogue: List of {"role": "user/assistant", "round": int, "content": str}
+        """
+        print(f"\n🎓 开始Tutoring Session")
+        print(f"   学生ID: {student_id}")
+        print(f"   Concept: {concept_text}")
+        print(f"   轮数: {NUM_TUTORING_ROUNDS}")
+        
+        dialogue = []
+        completed_rounds = 0
+        if checkpoint_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(checkpoint_file)), exist_ok=True)
+            dialogue = self.load_checkpoint(checkpoint_file)
+            completed_rounds = dialogue[-1]['round'] if dialogue else 0
+            if completed_rounds > 0:
+                print(f"   ♻️  从checkpoint恢复，已完成{completed_rounds}轮")
+        
+        if completed_rounds == 0:
+            # 第一轮：学生表达想学习
+            initial_query = f"I want to learn about {concept_text}"
+            dialogue.append({
+                "role": "user",
+                "round": 0,
+                "content": initial_query
+            })
+            
+            # RAG检索并重写
+            print(f"\n📚 Round 1: 生成初始问题")
+            retrieval = self.retrieve_for_turn(initial_query, student_id, dataset, concept_text)
+            
+            # 生成第一个问题
+            first_question = self.tutor_reply(dialogue, concept_text, retrieval)
+            
+            dialogue.append({
+                "role": "assistant",
+                "round": 1,
+                "content": first_question,
+                **retrieval
+            })
+            
+            if checkpoint_file is not None:
+                self.append_checkpoint(checkpoint_file, 1, dialogue[-2:])
+            completed_rounds = 1
+            
+            print(f"   ✅ 问题已生成")
         
         # 后续9轮：学生回答 -> RAG -> 讲解+问题
-        for round_num in range(2, NUM_TUTORING_ROUNDS + 1):
+        for round_num in range(completed_rounds + 1, NUM_TUTORING_ROUNDS + 1):
             print(f"\n📚 Round {round_num}")
             
             # 学生回答上一轮的问题
@@ -225,56 +336,42 @@ Keep your response clear, encouraging, and pedagogically sound."""
             
             print(f"   📝 学生已回答")
             
-            # RAG检索当前query（学生的回答）
-            top_persona, top_memory = self.rag.retrieve_and_rerank(
-                query=student_answer,
-                student_id=student_id,
-                dataset=dataset,
-                concept_text=concept_text
-            )
-            
-            # 重写
-            rewritten_persona, rewritten_memory = self.rewriter.rewrite_top_items(
-                top_persona, top_memory,
-                student_id=student_id,
-                dataset=dataset,
-                concept_text=concept_text
-            )
+            # RAG检索当前query（学生的回答）并重写
+            retrieval = self.retrieve_for_turn(student_answer, student_id, dataset, concept_text)
             
             # 生成讲解+下一个问题
-            conversation_history = [{"role": msg["role"], "content": msg["content"]} 
-                                   for msg in dialogue]
-            
-            explanation_and_question = self.generate_explanation_and_question(
-                rewritten_persona, rewritten_memory,
-                conversation_history, concept_text
-            )
+            explanation_and_question = self.tutor_reply(dialogue, concept_text, retrieval)
             
             dialogue.append({
                 "role": "assistant",
                 "round": round_num,
                 "content": explanation_and_question,
-                "retrieved_persona": [p['description'] for p in top_persona],
-                "retrieved_memory": [m['description'] for m in top_memory],
-                "rewritten_persona": rewritten_persona,
-                "rewritten_memory": rewritten_memory
+                **retrieval
             })
             
+            if checkpoint_file is not None:
+                self.append_checkpoint(checkpoint_file, round_num, dialogue[-2:])
+            
             print(f"   ✅ 讲解+问题已生成")
         
         print(f"\n✅ Tutoring Session完成！共{len(dialogue)}条消息")
         
         return dialogue
     
-    def save_dialogue(self, dialogue: List[Dict], student_id: int, concept_text: str, dataset: str, backbone_suffix: str = ''):
-        """保存对话到文件，根据backbone使用不同目录"""
-        # 创建目录 (加上backbone后缀以区分不同模型生成的dialogue，加上FS_METHOD以区分不同遗忘曲线方法)
+    def dialogue_path(self, student_id: int, concept_text: str, dataset: str, backbone_suffix: str = '') -> str:
+        """对话文件路径 (加上backbone后缀以区分不同模型生成的dialogue，加上FS_METHOD以区分不同遗忘曲线方法)"""
         from tasa_config import FORGETTING_SCORE_METHOD
         dialogue_dir = f"{DIALOGUE_DIR}{backbone_suffix}/{dataset}/{FORGETTING_SCORE_METHOD}"
-        os.makedirs(dialogue_dir, exist_ok=True)
-        
-        # 保存
-        filename = f"{dialogue_dir}/{student_id}-{concept_text}.json"
+        return f"{dialogue_dir}/{student_id}-{concept_text}.json"
+    
+    def checkpoint_path(self, student_id: int, concept_text: str, dataset: str, backbone_suffix: str = '') -> str:
+        """per-round checkpoint路径（与对话文件放在一起）"""
+        return self.dialogue_path(student_id, concept_text, dataset, backbone_suffix) + ".ckpt.jsonl"
+    
+    def save_dialogue(self, dialogue: List[Dict], student_id: int, concept_text: str, dataset: str, backbone_suffix: str = ''):
+        """保存对话到文件，根据backbone使用不同目录（完成后删除对应的checkpoint）"""
+        filename = self.dialogue_path(student_id, concept_text, dataset, backbone_suffix)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
         
         dialogue_data = {
             "student_id": student_id,
@@ -284,8 +381,14 @@ Keep your response clear, encouraging, and pedagogically sound."""
             "dialogue": dialogue
         }
         
-        with open(filename, 'w') as f:
+        # 先写临时文件再替换，避免崩溃时留下不完整的对话文件（批量运行会跳过已存在的对话）
+        with open(filename + ".tmp", 'w') as f:
             json.dump(dialogue_data, f, indent=2)
+        os.replace(filename + ".tmp", filename)
+        
+        checkpoint_file = self.checkpoint_path(student_id, concept_text, dataset, backbone_suffix)
+        if os.path.exists(checkpoint_file):
+            os.remove(checkpoint_file)
         
         print(f"💾 对话已保存至: {filename}")
         return filename
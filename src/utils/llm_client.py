@@ -3,14 +3,596 @@
 统一的LLM客户端，支持GPT, Llama, Qwen
 """
 import os
+import json
+import time
+import hashlib
+import random
+import sqlite3
+import asyncio
+import threading
+import weakref
+import importlib.util
 import httpx
-from openai import OpenAI
+from concurrent.futures import Future
+from typing import Callable, Iterator, Optional
+from openai import OpenAI, AsyncOpenAI, APIError
 
 # API配置
 LLAMA_URL = "https://85bb6ded8e37.ngrok-free.app/predict/"
 QWEN_URL = "https://5d80b2bc05ca.ngrok-free.app/predict/"
 TIMEOUT = 120  # 增加timeout以应对复杂prompt
 
+# 连接池配置（每个backend一个进程级共享的keep-alive连接池）
+POOL_SIZES = {
+    'llama': 32,
+    'qwen': 32,
+    'openai': 64,   # 所有OpenAI兼容endpoint（GPT tutor、Student、Grader、Rewriter）
+}
+KEEPALIVE_EXPIRY = 60  # 空闲连接保持时间（秒）
+HTTP2 = importlib.util.find_spec('h2') is not None  # 安装了h2时启用HTTP/2
+
+# 限流与重试配置（每个backend独立；None表示不限）
+RATE_LIMITS = {
+    'llama': {'rpm': None, 'tpm': None},
+    'qwen': {'rpm': None, 'tpm': None},
+    'openai': {'rpm': 3000, 'tpm': 2_000_000},
+}
+RATE_BURST_SECONDS = 10         # 令牌桶容量：允许突发多少秒的配额
+MAX_RETRIES = 5                 # 可重试错误的最大重试次数
+BACKOFF_BASE = 1.0              # 指数退避基数（秒）
+BACKOFF_MAX = 60.0              # 单次退避上限（秒）
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+AIMD_DECREASE_COOLDOWN = 1.0    # 两次并发减半之间的最小间隔（秒），避免一波429把并发压到1
+
+# 响应缓存（record/replay）："off" / "read_through"（命中直接返回，未命中调用并写入）/
+# "record"（总是调用并写入）/ "replay"（只读缓存，不访问网络，用于离线复现）
+RESPONSE_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "off")
+RESPONSE_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "/mnt/localssd/bank/cache/llm_responses.sqlite")
+RESPONSE_CACHE_MODES = ("off", "read_through", "record", "replay")
+
+_HTTP_CLIENTS = {}
+_OPENAI_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+class LLMRequestError(RuntimeError):
+    """LLM调用失败：重试用尽后仍然限流/超时/连接失败，或返回错误状态码"""
+
+
+def reraise_cache_miss(e: BaseException):
+    """
+    e或其cause/context链中有ResponseCacheMiss时重新抛出它
+    （OpenAI SDK会把transport中的异常包装成APIConnectionError，replay未命中不能被当作普通失败吞掉）
+    """
+    seen = set()
+    while e is not None and id(e) not in seen:
+        if isinstance(e, ResponseCacheMiss):
+            raise e
+        seen.add(id(e))
+        e = e.__cause__ or e.__context__
+
+
+def raise_for_llm_error(e: Exception, backend: str):
+    """e是API调用层面的失败（SDK/HTTP错误，此时transport的重试已经用尽）时抛出LLMRequestError，其他异常直接返回"""
+    reraise_cache_miss(e)
+    if isinstance(e, LLMRequestError):
+        raise e
+    if isinstance(e, (APIError, httpx.HTTPError)):
+        raise LLMRequestError(f"{backend} API调用失败: {e}") from e
+
+
+class TokenBucket:
+    """按分钟配额的令牌桶；reserve先扣额度（可以透支），返回需要等待的秒数"""
+    
+    def __init__(self, per_minute: float, burst_seconds: float = RATE_BURST_SECONDS):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+def _resolve_waiter(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class BackendGuard:
+    """
+    一个backend的限流状态：
+    - 请求数/token数令牌桶（RATE_LIMITS）
+    - AIMD自适应并发：成功时并发上限每轮+1，遇到429时减半
+    """
+    
+    def __init__(self, backend: str, rpm: Optional[float] = None, tpm: Optional[float] = None,
+                 max_concurrency: int = 32):
+        self.backend = backend
+        self.request_bucket = TokenBucket(rpm) if rpm else None
+        self.token_bucket = TokenBucket(tpm) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        self._async_waiters = []  # [(loop, future)]：aacquire中等待空位的协程，release时在各自的事件循环中唤醒
+        self._last_decrease = 0.0
+        self.requests = 0
+        self.retries = 0
+        self.throttled = 0
+    
+    def reserve(self, tokens: int) -> float:
+        """预留一个请求和tokens个token的配额，返回需要等待的秒数"""
+        delays = [0.0]
+        if self.request_bucket is not None:
+            delays.append(self.request_bucket.reserve(1))
+        if self.token_bucket is not None:
+            delays.append(self.token_bucket.reserve(tokens))
+        return max(delays)
+    
+    def try_acquire(self) -> bool:
+        with self._cond:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                self.requests += 1
+                return True
+            return False
+    
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                self._cond.wait()
+            self.in_flight += 1
+            self.requests += 1
+    
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    self.requests += 1
+                    return
+                waiter = (loop, loop.create_future())
+                self._async_waiters.append(waiter)
+            try:
+                await waiter[1]
+            finally:
+                with self._cond:
+                    if waiter in self._async_waiters:
+                        self._async_waiters.remove(waiter)
+    
+    def _wake_async_waiters(self):
+        """唤醒所有aacquire中等待的协程重新检查（与notify_all语义一致；调用方需持有_cond）"""
+        for loop, future in self._async_waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve_waiter, future)
+            except RuntimeError:
+                pass  # 事件循环已关闭
+        self._async_waiters.clear()
+    
+    def release(self, status_code: Optional[int]):
+        with self._cond:
+            self.in_flight -= 1
+            if status_code == 429:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= AIMD_DECREASE_COOLDOWN:
+                    self.limit = max(1.0, self.limit / 2)
+                    self._last_decrease = now
+            elif status_code is not None and status_code < 400:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            self._cond.notify_all()
+            self._wake_async_waiters()
+    
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'requests': self.requests,
+                'retries': self.retries,
+                'throttled': self.throttled,
+            }
+
+
+_GUARDS = {}
+
+
+def get_backend_guard(backend: str) -> BackendGuard:
+    """进程级共享的backend限流状态"""
+    with _CLIENTS_LOCK:
+        guard = _GUARDS.get(backend)
+        if guard is None:
+            limits = RATE_LIMITS.get(backend, {})
+            guard = BackendGuard(backend, limits.get('rpm'), limits.get('tpm'), POOL_SIZES.get(backend, 32))
+            _GUARDS[backend] = guard
+        return guard
+
+
+def backend_stats() -> dict:
+    """所有backend的限流/重试统计"""
+    return {backend: guard.stats() for backend, guard in _GUARDS.items()}
+
+
+def estimate_request_tokens(request: httpx.Request) -> int:
+    """粗略估计一次请求消耗的token数：prompt字符数/4 + max_tokens"""
+    try:
+        body = json.loads(request.content or b'{}')
+    except (ValueError, httpx.RequestNotRead):
+        return 0
+    if not isinstance(body, dict):
+        return 0
+    
+    chars = sum(len(str(msg.get('content', ''))) for msg in body.get('messages', []))
+    chars += len(body.get('system_prompt', '')) + len(body.get('user_prompt', ''))
+    return chars // 4 + int(body.get('max_tokens') or 0)
+
+
+def backoff_delay(attempt: int, response: Optional[httpx.Response] = None) -> float:
+    """指数退避 + full jitter；响应带Retry-After时优先使用"""
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        try:
+            if retry_after is not None:
+                return min(BACKOFF_MAX, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+class ResponseCacheMiss(RuntimeError):
+    """replay模式下请求不在缓存中"""
+
+
+class ResponseCache:
+    """
+    LLM响应的持久化缓存（SQLite），在共享连接池的transport层生效，覆盖所有调用方（Tutor、Student、Rewriter、Grader）
+    
+    key = hash(backend, URL路径, 规范化的JSON请求体)，不含host（ngrok地址变化不影响命中）。
+    同一个key在一次运行中第n次出现对应第n个样本，因此temperature>0的调用（如学生role-play）重放时也按原顺序返回；
+    replay模式下样本不够时循环使用已有样本。只缓存200响应（流式响应完整读取后缓存，命中时一次性返回）
+    """
+    
+    def __init__(self, path: str = RESPONSE_CACHE_PATH, mode: str = RESPONSE_CACHE_MODE):
+        if mode not in RESPONSE_CACHE_MODES or mode == "off":
+            raise ValueError(f"Unknown response cache mode: {mode}")
+        
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.mode = mode
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                               '(key TEXT, idx INTEGER, content_type TEXT, body BLOB, created_at REAL, '
+                               'PRIMARY KEY (key, idx))')
+            self._conn.commit()
+        self._occurrences = {}
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+    
+    @staticmethod
+    def make_key(backend: str, request: httpx.Request) -> str:
+        try:
+            body = json.dumps(json.loads(request.content or b'null'), sort_keys=True, ensure_ascii=False)
+        except ValueError:
+            body = request.content.decode('utf-8', errors='replace')
+        payload = json.dumps([backend, request.method, request.url.path, body], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def lookup(self, key: str):
+        """
+        返回 (idx, 缓存的响应)：idx是本次出现对应的样本序号；
+        需要调用上游时响应为None，replay模式下未命中抛出ResponseCacheMiss
+        """
+        with self._lock:
+            idx = self._occurrences.get(key, 0)
+            self._occurrences[key] = idx + 1
+            if self.mode == "record":
+                return idx, None
+            
+            rows = self._conn.execute('SELECT content_type, body FROM responses WHERE key = ? ORDER BY idx',
+                                      (key,)).fetchall()
+            if idx < len(rows) or (self.mode == "replay" and rows):
+                self.hits += 1
+                return idx, self.to_response(*rows[idx % len(rows)])
+            
+            self.misses += 1
+        if self.mode == "replay":
+            raise ResponseCacheMiss(f"Request not in response cache ({self.path}): {key}")
+        return idx, None
+    
+    @staticmethod
+    def to_response(content_type: str, body: bytes) -> httpx.Response:
+        return httpx.Response(200, headers={'content-type': content_type}, content=body)
+    
+    def store(self, key: str, idx: int, response: httpx.Response) -> httpx.Response:
+        """写入已读取完的200响应，返回与缓存命中时相同的响应（录制和重放时调用方看到的内容一致）"""
+        content_type = response.headers.get('content-type', '')
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, idx, content_type, body, created_at) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, idx, content_type, response.content, time.time()))
+            self._conn.commit()
+            self.writes += 1
+        return self.to_response(content_type, response.content)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {'mode': self.mode, 'hits': self.hits, 'misses': self.misses, 'writes': self.writes}
+
+
+_RESPONSE_CACHE = None
+_RESPONSE_CACHE_CONFIGURED = False
+
+
+def configure_response_cache(mode: str = RESPONSE_CACHE_MODE, path: str = RESPONSE_CACHE_PATH) -> Optional[ResponseCache]:
+    """设置进程级响应缓存（需在第一次LLM调用前调用；默认读取环境变量LLM_CACHE_MODE / LLM_CACHE_PATH）"""
+    global _RESPONSE_CACHE, _RESPONSE_CACHE_CONFIGURED
+    with _CLIENTS_LOCK:
+        _RESPONSE_CACHE = ResponseCache(path, mode) if mode != "off" else None
+        _RESPONSE_CACHE_CONFIGURED = True
+        return _RESPONSE_CACHE
+
+
+def get_response_cache() -> Optional[ResponseCache]:
+    if not _RESPONSE_CACHE_CONFIGURED:
+        configure_response_cache()
+    return _RESPONSE_CACHE
+
+
+class RateLimitedTransport(httpx.HTTPTransport):
+    """
+    在连接池之上做限流、AIMD并发控制，以及对可重试错误（RETRYABLE_STATUS、超时、连接错误）的退避重试；
+    开启响应缓存时先查缓存，命中的请求不经过限流也不访问网络
+    """
+    
+    def __init__(self, backend: str, **kwargs):
+        super().__init__(**kwargs)
+        self.backend = backend
+        self.guard = get_backend_guard(backend)
+    
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        cache = get_response_cache()
+        if cache is None:
+            return self._send(request)
+        
+        key = cache.make_key(self.backend, request)
+        idx, cached = cache.lookup(key)
+        if cached is not None:
+            return cached
+        
+        response = self._send(request)
+        if response.status_code == 200:
+            try:
+                response.read()
+            except BaseException:
+                response.close()
+                raise
+            return cache.store(key, idx, response)
+        return response
+    
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_request_tokens(request)
+        for attempt in range(MAX_RETRIES + 1):
+            time.sleep(self.guard.reserve(tokens))
+            self.guard.acquire()
+            try:
+                response = super().handle_request(request)
+            except httpx.TransportError:
+                self.guard.release(None)
+                if attempt == MAX_RETRIES:
+                    raise
+                self.guard.retries += 1
+                time.sleep(backoff_delay(attempt))
+                continue
+            
+            self.guard.release(response.status_code)
+            if response.status_code not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                return response
+            
+            self.guard.retries += 1
+            response.close()
+            time.sleep(backoff_delay(attempt, response))
+
+
+class AsyncRateLimitedTransport(httpx.AsyncHTTPTransport):
+    """RateLimitedTransport的异步版本（与同步版本共享backend的限流状态和响应缓存）"""
+    
+    def __init__(self, backend: str, **kwargs):
+        super().__init__(**kwargs)
+        self.backend = backend
+        self.guard = get_backend_guard(backend)
+    
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        cache = get_response_cache()
+        if cache is None:
+            return await self._send(request)
+        
+        # SQLite读写在线程中执行，不阻塞事件循环
+        key = cache.make_key(self.backend, request)
+        idx, cached = await asyncio.to_thread(cache.lookup, key)
+        if cached is not None:
+            return cached
+        
+        response = await self._send(request)
+        if response.status_code == 200:
+            try:
+                await response.aread()
+            except BaseException:
+                await response.aclose()
+                raise
+            return await asyncio.to_thread(cache.store, key, idx, response)
+        return response
+    
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        tokens = estimate_request_tokens(request)
+        for attempt in range(MAX_RETRIES + 1):
+            await asyncio.sleep(self.guard.reserve(tokens))
+            await self.guard.aacquire()
+            try:
+                response = await super().handle_async_request(request)
+            except httpx.TransportError:
+                self.guard.release(None)
+                if attempt == MAX_RETRIES:
+                    raise
+                self.guard.retries += 1
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            
+            self.guard.release(response.status_code)
+            if response.status_code not in RETRYABLE_STATUS or attempt == MAX_RETRIES:
+                return response
+            
+            self.guard.retries += 1
+            await response.aclose()
+            await asyncio.sleep(backoff_delay(attempt, response))
+
+
+def _pool_limits(backend: str) -> httpx.Limits:
+    pool_size = POOL_SIZES.get(backend, 32)
+    return httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def get_http_client(backend: str) -> httpx.Client:
+    """进程级共享的httpx连接池（按backend区分，池大小见POOL_SIZES，带限流和重试）"""
+    with _CLIENTS_LOCK:
+        client = _HTTP_CLIENTS.get(backend)
+    if client is not None:
+        return client
+    
+    transport = RateLimitedTransport(backend, http2=HTTP2, limits=_pool_limits(backend))
+    client = httpx.Client(timeout=TIMEOUT, transport=transport)
+    with _CLIENTS_LOCK:
+        return _HTTP_CLIENTS.setdefault(backend, client)
+
+
+def get_openai_client(api_key: str, base_url: str) -> OpenAI:
+    """进程级共享的OpenAI客户端（相同api_key+base_url复用同一个实例，底层使用共享连接池）"""
+    with _CLIENTS_LOCK:
+        client = _OPENAI_CLIENTS.get((api_key, base_url))
+        if client is not None:
+            return client
+    
+    # 重试由共享连接池的transport负责，关闭SDK自带的重试以免叠加
+    client = OpenAI(api_key=api_key, base_url=base_url, http_client=get_http_client('openai'), max_retries=0)
+    with _CLIENTS_LOCK:
+        return _OPENAI_CLIENTS.setdefault((api_key, base_url), client)
+
+
+# 异步客户端的连接池绑定在事件循环上，因此按事件循环分别缓存
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+
+def _loop_clients() -> dict:
+    loop = asyncio.get_running_loop()
+    with _CLIENTS_LOCK:
+        return _ASYNC_CLIENTS.setdefault(loop, {})
+
+
+def get_async_http_client(backend: str) -> httpx.AsyncClient:
+    """当前事件循环内共享的httpx.AsyncClient连接池（按backend区分）"""
+    clients = _loop_clients()
+    client = clients.get(('http', backend))
+    if client is None:
+        transport = AsyncRateLimitedTransport(backend, http2=HTTP2, limits=_pool_limits(backend))
+        client = httpx.AsyncClient(timeout=TIMEOUT, transport=transport)
+        clients[('http', backend)] = client
+    return client
+
+
+def get_async_openai_client(api_key: str, base_url: str) -> AsyncOpenAI:
+    """当前事件循环内共享的AsyncOpenAI客户端"""
+    clients = _loop_clients()
+    client = clients.get(('openai', api_key, base_url))
+    if client is None:
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=get_async_http_client('openai'),
+                             max_retries=0)
+        clients[('openai', api_key, base_url)] = client
+    return client
+
+
+def request_key(model: str, messages: list, temperature: float, max_tokens: int) -> str:
+    """请求的规范化哈希：相同 (model, messages, temperature, max_tokens) 得到相同的key"""
+    payload = json.dumps([model, messages, temperature, max_tokens], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SingleFlight:
+    """
+    合并同时在途的相同请求：同一个key同一时刻只有一个上游调用，其他调用者等待并共享它的结果（或异常）
+    
+    只合并在途请求，调用完成后不保留结果（持久化复用由缓存负责）
+    """
+    
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._async_calls = weakref.WeakKeyDictionary()  # 事件循环 -> {key: Task}
+        self.leaders = 0
+        self.shared = 0
+    
+    def do(self, key: str, fn: Callable):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.leaders += 1
+            else:
+                self.shared += 1
+        
+        if not leader:
+            return future.result()
+        
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
+    
+    async def ado(self, key: str, coro_fn: Callable):
+        """异步版本：coro_fn只在成为leader时调用；某个等待者被取消不会取消共享的上游调用"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            calls = self._async_calls.setdefault(loop, {})
+            task = calls.get(key)
+            if task is None:
+                task = calls[key] = asyncio.ensure_future(coro_fn())
+                task.add_done_callback(lambda _: calls.pop(key, None))
+                self.leaders += 1
+            else:
+                self.shared += 1
+        return await asyncio.shield(task)
+    
+    def stats(self) -> dict:
+        with self._lock:
+            return {'upstream_calls': self.leaders, 'coalesced': self.shared}
+
+
+_SINGLE_FLIGHT = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    """进程级共享的single-flight（所有UnifiedLLMClient实例共用）"""
+    return _SINGLE_FLIGHT
+
+
 class UnifiedLLMClient:
     def __init__(self, model_name: str):
         self.model_name = model_name
@@ -44,14 +626,14 @@ class UnifiedLLMClient:
                     # 最后尝试从tasa_config_gpt导入
                     from tasa_config_gpt import API_KEY as api_key, ENDPOINT as endpoint
             
-            self.client = OpenAI(
-                api_key=api_key,
-                base_url=endpoint
-            )
+            self.api_key = api_key
+            self.endpoint = endpoint
+            self.client = get_openai_client(api_key, endpoint)
         else:
             raise ValueError(f"Unknown model: {model_name}")
     
-    def chat_completion(self, messages: list, temperature: float = 0.7, max_tokens: int = 2000):
+    def chat_completion(self, messages: list, temperature: float = 0.7, max_tokens: int = 2000,
+                        coalesce: bool = False):
         """
         统一的对话API
         
@@ -59,15 +641,117 @@ class UnifiedLLMClient:
             messages: [{"role": "system", "content": "..."}, {"role": "user", "content": "..."}]
             temperature: 温度参数
             max_tokens: 最大token数
+            coalesce: 与同时在途的相同请求共享一次上游调用（需要独立采样的调用方，如学生role-play，不要开启）
         
         Returns:
             str: 模型生成的回复内容
+        
+        Raises:
+            LLMRequestError: 重试用尽后仍然失败（限流、超时、连接错误、错误状态码）
         """
+        if coalesce:
+            key = request_key(self.model_name, messages, temperature, max_tokens)
+            return _SINGLE_FLIGHT.do(key, lambda: self._call(messages, temperature, max_tokens))
+        return self._call(messages, temperature, max_tokens)
+    
+    def _call(self, messages: list, temperature: float, max_tokens: int) -> str:
         if self.backend == 'gpt':
             return self._call_gpt(messages, temperature, max_tokens)
         elif self.backend in ['llama', 'qwen']:
             return self._call_custom(messages, temperature, max_tokens)
     
+    def chat_completion_stream(self, messages: list, temperature: float = 0.7, max_tokens: int = 2000) -> Iterator[str]:
+        """
+        流式对话API：逐段yield生成的文本，拼接后与chat_completion的返回一致
+        
+        - GPT: OpenAI兼容的SSE流（stream=True）
+        - Llama/Qwen: /predict 返回SSE或分块文本时边读边yield；不支持流式时一次性yield完整结果
+        
+        重试用尽后仍然失败时（包括已经yield了部分文本之后）抛出LLMRequestError，与chat_completion一致
+        """
+        if self.backend == 'gpt':
+            return self._stream_gpt(messages, temperature, max_tokens)
+        elif self.backend in ['llama', 'qwen']:
+            return self._stream_custom(messages, temperature, max_tokens)
+    
+    async def achat_completion(self, messages: list, temperature: float = 0.7, max_tokens: int = 2000,
+                               timeout: Optional[float] = None, coalesce: bool = False) -> str:
+        """
+        异步对话API（行为与chat_completion一致：重试用尽后失败或超时时抛出LLMRequestError）
+        
+        Args:
+            timeout: 本次调用的总超时（秒），None表示使用客户端默认超时
+            coalesce: 与同一事件循环中同时在途的相同请求共享一次上游调用
+        
+        取消（asyncio.CancelledError）会直接向上传播，同时释放底层连接
+        （开启coalesce时，取消只影响当前调用者，共享的上游调用会继续完成）
+        """
+        if coalesce:
+            key = request_key(self.model_name, messages, temperature, max_tokens)
+            call = _SINGLE_FLIGHT.ado(key, lambda: self._acall(messages, temperature, max_tokens, timeout))
+        else:
+            call = self._acall(messages, temperature, max_tokens, timeout)
+        
+        if timeout is None:
+            return await call
+        try:
+            return await asyncio.wait_for(call, timeout)
+        except asyncio.TimeoutError as e:
+            raise LLMRequestError(f"{self.backend.upper()} API调用超时 ({timeout}s)") from e
+    
+    def _acall(self, messages: list, temperature: float, max_tokens: int, timeout: Optional[float] = None):
+        if self.backend == 'gpt':
+            return self._acall_gpt(messages, temperature, max_tokens, timeout)
+        elif self.backend in ['llama', 'qwen']:
+            return self._acall_custom(messages, temperature, max_tokens, timeout)
+    
+    async def _acall_gpt(self, messages: list, temperature: float, max_tokens: int,
+                         timeout: Optional[float] = None) -> str:
+        """异步调用GPT API"""
+        try:
+            client = get_async_openai_client(self.api_key, self.endpoint)
+            response = await client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                **({'timeout': timeout} if timeout is not None else {})
+            )
+            
+            if response.choices[0].message.content:
+                return response.choices[0].message.content
+            else:
+                return ""
+        except Exception as e:
+            raise_for_llm_error(e, 'GPT')
+            print(f"   ⚠️ GPT API调用失败: {e}")
+            return ""
+    
+    async def _acall_custom(self, messages: list, temperature: float, max_tokens: int,
+                            timeout: Optional[float] = None) -> str:
+        """异步调用Llama/Qwen自定义API"""
+        try:
+            system_prompt, user_prompt = self._build_prompts(messages)
+            
+            response = await get_async_http_client(self.backend).post(
+                self.api_url,
+                json={
+                    "system_prompt": system_prompt,
+                    "user_prompt": user_prompt
+                },
+                timeout=timeout if timeout is not None else TIMEOUT
+            )
+            
+            if response.status_code != 200:
+                raise LLMRequestError(f"{self.backend.upper()} API返回错误: {response.status_code}")
+            result = response.json()
+            return result.get('result', '')
+        
+        except Exception as e:
+            raise_for_llm_error(e, self.backend.upper())
+            print(f"   ⚠️ {self.backend.upper()} API调用失败: {e}")
+            return ""
+    
     def _call_gpt(self, messages: list, temperature: float, max_tokens: int) -> str:
         """调用GPT API"""
         try:
@@ -83,45 +767,121 @@ class UnifiedLLMClient:
             else:
                 return ""
         except Exception as e:
+            raise_for_llm_error(e, 'GPT')
             print(f"   ⚠️ GPT API调用失败: {e}")
             return ""
     
+    def _stream_gpt(self, messages: list, temperature: float, max_tokens: int) -> Iterator[str]:
+        """流式调用GPT API"""
+        try:
+            stream = self.client.chat.completions.create(
+                model=self.model_name,
+                messages=messages,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        except Exception as e:
+            raise_for_llm_error(e, 'GPT')
+            print(f"   ⚠️ GPT API流式调用失败: {e}")
+    
+    def _build_prompts(self, messages: list):
+        """将messages转换为system_prompt和user_prompt"""
+        system_prompt = ""
+        user_prompt = ""
+        
+        for msg in messages:
+            if msg["role"] == "system":
+                system_prompt += msg["content"] + "\n"
+            elif msg["role"] == "user":
+                user_prompt += msg["content"] + "\n"
+            elif msg["role"] == "assistant":
+                # 对于历史对话，追加到user_prompt
+                user_prompt += f"Assistant: {msg['content']}\n"
+        
+        return system_prompt.strip(), user_prompt.strip()
+    
     def _call_custom(self, messages: list, temperature: float, max_tokens: int) -> str:
         """调用Llama/Qwen自定义API"""
         try:
-            # 将messages转换为system_prompt和user_prompt
-            system_prompt = ""
-            user_prompt = ""
-            
-            for msg in messages:
-                if msg["role"] == "system":
-                    system_prompt += msg["content"] + "\n"
-                elif msg["role"] == "user":
-                    user_prompt += msg["content"] + "\n"
-                elif msg["role"] == "assistant":
-                    # 对于历史对话，追加到user_prompt
-                    user_prompt += f"Assistant: {msg['content']}\n"
-            
-            # 调用API
-            with httpx.Client(timeout=TIMEOUT) as client:
-                response = client.post(
-                    self.api_url,
-                    json={
-                        "system_prompt": system_prompt.strip(),
-                        "user_prompt": user_prompt.strip()
-                    }
-                )
-                
-                if response.status_code == 200:
-                    result = response.json()
-                    return result.get('result', '')
-                else:
-                    print(f"   ⚠️ {self.backend.upper()} API返回错误: {response.status_code}")
-                    return ""
+            system_prompt, user_prompt = self._build_prompts(messages)
+            
+            # 调用API（复用backend的keep-alive连接池）
+            response = get_http_client(self.backend).post(
+                self.api_url,
+                json={
+                    "system_prompt": system_prompt,
+                    "user_prompt": user_prompt
+                }
+            )
+            
+            if response.status_code != 200:
+                raise LLMRequestError(f"{self.backend.upper()} API返回错误: {response.status_code}")
+            result = response.json()
+            return result.get('result', '')
         
         except Exception as e:
+            raise_for_llm_error(e, self.backend.upper())
             print(f"   ⚠️ {self.backend.upper()} API调用失败: {e}")
             return ""
+    
+    def _stream_custom(self, messages: list, temperature: float, max_tokens: int) -> Iterator[str]:
+        """
+        流式调用Llama/Qwen自定义API（请求中带 "stream": true）
+        
+        - text/event-stream: 每个 "data:" 事件是JSON（{"token": ...} / {"result": ...}）或纯文本，"[DONE]"结束
+        - application/json: 服务端不支持流式，一次性yield完整的result
+        - 其他（分块文本）: 按块yield
+        """
+        try:
+            system_prompt, user_prompt = self._build_prompts(messages)
+            
+            with get_http_client(self.backend).stream(
+                "POST",
+                self.api_url,
+                json={
+                    "system_prompt": system_prompt,
+                    "user_prompt": user_prompt,
+                    "stream": True
+                }
+            ) as response:
+                if response.status_code != 200:
+                    raise LLMRequestError(f"{self.backend.upper()} API返回错误: {response.status_code}")
+                
+                content_type = response.headers.get('content-type', '')
+                if 'text/event-stream' in content_type:
+                    for line in response.iter_lines():
+                        if not line.startswith('data:'):
+                            continue
+                        data = line[5:]
+                        if data.startswith(' '):
+                            data = data[1:]  # SSE规范：去掉data:后的一个空格
+                        if data.strip() == '[DONE]':
+                            break
+                        try:
+                            event = json.loads(data)
+                            token = event.get('token', event.get('result', '')) if isinstance(event, dict) else str(event)
+                        except json.JSONDecodeError:
+                            token = data
+                        if token:
+                            yield token
+                elif 'application/json' in content_type:
+                    response.read()
+                    result = response.json().get('result', '')
+                    if result:
+                        yield result
+                else:
+                    for chunk in response.iter_text():
+                        if chunk:
+                            yield chunk
+        
+        except Exception as e:
+            raise_for_llm_error(e, self.backend.upper())
+            print(f"   ⚠️ {self.backend.upper()} API流式调用失败: {e}")
 
 
 # 便捷函数
@@ -129,3 +889,39 @@ def get_llm_client(model_name: str) -> UnifiedLLMClient:
     """获取LLM客户端"""
     return UnifiedLLMClient(model_name)
 
+
+
+if __name__ == "__main__":
+    # 自检：上游一直返回429时，流式调用在重试用尽后必须抛出LLMRequestError，而不是静默返回空文本
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    
+    hits = []
+    
+    class _Always429(BaseHTTPRequestHandler):
+        def do_POST(self):
+            hits.append(self.path)
+            self.rfile.read(int(self.headers.get('content-length', 0)))
+            self.send_response(429)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        
+        def log_message(self, *args):
+            pass
+    
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Always429)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    
+    client = UnifiedLLMClient('llama')
+    client.api_url = f"http://127.0.0.1:{server.server_address[1]}/predict/"
+    try:
+        text = "".join(client.chat_completion_stream([{"role": "user", "content": "ping"}]))
+    except LLMRequestError as e:
+        print(f"收到LLMRequestError: {e}")
+    else:
+        raise AssertionError(f"429重试用尽后流式调用没有抛出异常（返回 {text!r}）")
+    finally:
+        server.shutdown()
+    
+    assert len(hits) == MAX_RETRIES + 1, f"期望 {MAX_RETRIES + 1} 次请求，实际 {len(hits)} 次"
+    print(f"✅ 429重试用尽后流式调用抛出LLMRequestError（共 {len(hits)} 次请求）")